@@ -38,10 +38,10 @@ STAGES = {
         'Vinto annuale con acc.impresa',
         'Vinti generici',
         'Ag.marketing/collaborazioni',
-        'Cliente Non vinto '],
-    'leadPersi': ['Numero Non corretto flusso di email marketing ',
+        'Cliente Non vinto'],
+    'leadPersi': ['Numero Non corretto flusso di email marketing',
         'Fuori target',
-        'Lead Perso ( 10 tentativi non risp)'],
+        'Lead Perso (10 tentativi non risp)'],
     'venditeGestione': ['Autonomo - Call Onboarding',
         'Call onboarding',
         'Cancellati - Da riprogrammare',
@@ -53,8 +53,15 @@ STAGES = {
         'Vinto mensile con acc.impresa',
         'Vinto annuale con acc.impresa',
         'Vinti generici'],
-    'persi': ['Non Pronto (in target)'
-        'Cliente Non vinto ']
+    'persi': ['Non Pronto (in target)',
+        'Cliente Non vinto']
+}
+
+# Canali pubblicitari del riepilogo dei lead: prefisso delle chiavi (lead_meta, lead_meta_vinti, ...) e valore del campo fonte
+ATTRIBUTION_SOURCES = {
+    'meta': 'Facebook Ads',
+    'google': 'Google Ads',
+    'tiktok': 'Tiktok Ads'
 }
 
 FIELDS = {
@@ -64,6 +71,19 @@ FIELDS = {
     'googleanalytics4': "datasource,source,account_id,account_name,date,campaign,sessions,engaged_sessions,active_users,page_path,user_engagement_duration"
 }
 
+# ID dei campi personalizzati dei contatti nel CRM, con il nome della colonna in attribution_data
+CUSTOM_FIELDS = {
+    'data_acquisizione': 'ok7yK4uSS6wh0S2DnZrz',
+    'fonte': 'UiALy82OthZAitbSZTOU',
+    'data_aggiornamento_UTM': 'U6YOWEUW5qpa7GEwj0MQ',
+    'campaign_id': 'KAeN2BZw4yg3HrZJ953G',
+    'campaign_source': 'bv2mwtwOf8lOJk0AGyCC',
+    'campaign_medium': 'PsuKaybjKzA5YirzWN5P',
+    'campaign_name': 'cgo2pmNOEliZzooENxwM',
+    'campaign_term': 'LfJ9fcY6Fney8A7MiEwH',
+    'campaign_content': '0r8SuUE9KTknXxnknYtl'
+}
+
 COMMERCIALI = {
     'setters': ['Jacqueline Sanchez', 'Valeria  Di Giacomo', 'Valentina Ferrari'],
     'venditori': ['Daniel Prigioni', 'Paolo Mancusi', 'Fabio Tavella', 'Federico Mancini']
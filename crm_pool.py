@@ -0,0 +1,167 @@
+import threading
+import time
+from collections import deque
+import environ
+import mysql.connector
+
+env = environ.Env()
+environ.Env.read_env()
+
+POOL_SIZE = env.int('crm_pool_size', default=5)
+IDLE_TIMEOUT = env.int('crm_pool_idle_timeout', default=300)
+CHECKOUT_TIMEOUT = env.int('crm_pool_timeout', default=30)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+class PooledConnection:
+    # Espone la connessione MySQL: close() la restituisce al pool invece di chiuderla
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def close(self):
+        if self._conn is not None:
+            self._pool.release(self._conn)
+            self._conn = None
+
+class CRMPool:
+    def __init__(self, size=POOL_SIZE, idle_timeout=IDLE_TIMEOUT, checkout_timeout=CHECKOUT_TIMEOUT):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.checkout_timeout = checkout_timeout
+
+        self._idle = deque()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self.stats = {
+            'acquisizioni': 0,
+            'connessioni_create': 0,
+            'connessioni_riusate': 0,
+            'scadute': 0,
+            'ping_falliti': 0,
+            'risultati_pendenti': 0,
+            'attesa_totale_s': 0.0,
+            'attesa_massima_s': 0.0
+        }
+
+    def _connect(self):
+        with self._lock:
+            self.stats['connessioni_create'] += 1
+
+        return mysql.connector.connect(
+            host=env('host'),
+            port=env('port'),
+            user=env('username'),
+            password=env('password'),
+            database=env('database'),
+            auth_plugin='caching_sha2_password')
+
+    def _take_idle(self):
+        # Scarta le connessioni rimaste inattive troppo a lungo e verifica le altre prima di usarle
+        while True:
+            with self._lock:
+                if not self._idle:
+                    return None
+                conn, released_at = self._idle.pop()
+
+            if time.monotonic() - released_at > self.idle_timeout:
+                self._discard(conn, 'scadute')
+                continue
+
+            try:
+                conn.ping(reconnect=False)
+            except mysql.connector.Error:
+                self._discard(conn, 'ping_falliti')
+                continue
+
+            with self._lock:
+                self.stats['connessioni_riusate'] += 1
+
+            return conn
+
+    def _sweep(self):
+        # Il pool è LIFO: le connessioni più vecchie restano in fondo e non verrebbero mai estratte.
+        # Quelle scadute vengono chiuse da qui prima che sia il server a farle cadere
+        expired = []
+        with self._lock:
+            while self._idle and time.monotonic() - self._idle[0][1] > self.idle_timeout:
+                expired.append(self._idle.popleft()[0])
+
+        for conn in expired:
+            self._discard(conn, 'scadute')
+
+    def _discard(self, conn, reason):
+        with self._lock:
+            self.stats[reason] += 1
+
+        try:
+            conn.close()
+        except mysql.connector.Error:
+            pass
+
+    def get_connection(self):
+        started = time.monotonic()
+        if not self._slots.acquire(timeout=self.checkout_timeout):
+            raise TimeoutError(f"Nessuna connessione al CRM disponibile dopo {self.checkout_timeout} secondi")
+        waited = time.monotonic() - started
+
+        with self._lock:
+            self.stats['acquisizioni'] += 1
+            self.stats['attesa_totale_s'] += waited
+            self.stats['attesa_massima_s'] = max(self.stats['attesa_massima_s'], waited)
+
+        try:
+            self._sweep()
+            conn = self._take_idle() or self._connect()
+        except Exception:
+            self._slots.release()
+            raise
+
+        return PooledConnection(self, conn)
+
+    def release(self, conn):
+        # Il rollback chiude la transazione aperta dalle SELECT: la prossima lettura
+        # non deve vedere lo snapshot della precedente
+        try:
+            if conn.unread_result:
+                # Un risultato non letto bloccherebbe la query successiva su questa connessione
+                self._discard(conn, 'risultati_pendenti')
+                return
+
+            conn.rollback()
+            with self._lock:
+                self._idle.append((conn, time.monotonic()))
+        except mysql.connector.Error:
+            self._discard(conn, 'ping_falliti')
+        finally:
+            self._slots.release()
+
+        self._sweep()
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats, inattive=len(self._idle), dimensione=self.size)
+
+def get_pool():
+    # Un solo pool per processo, condiviso da sessioni e rerun e creato al primo aggiornamento dal CRM
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            _pool = CRMPool()
+
+    return _pool
+
+def use_pool(pool):
+    # Sostituisce il pool di processo, ad esempio con il finto CRM di tools/fake_crm.py
+    global _pool
+
+    with _pool_lock:
+        _pool = pool
+
+def get_pool_stats():
+    return _pool.get_stats() if _pool is not None else None
@@ -1,31 +1,139 @@
+import re
 import pandas as pd
 import streamlit as st
 import datetime
 import environ
 
-from config import STAGES, COMMERCIALI
-from db import get_data
+from config import STAGES, COMMERCIALI, ATTRIBUTION_SOURCES
+from db import get_data, get_data_versions
+from result_cache import cached
+
+def normalize_stage(name):
+    # Nel CRM gli stage compaiono con spazi finali, spazi doppi o "( " al posto di "("
+    return re.sub(r'\s+', ' ', str(name)).replace('( ', '(').replace(' )', ')').strip().casefold()
+
+# Nome normalizzato -> nome dello stage in config.STAGES, calcolato una volta all'avvio
+STAGE_INDEX = {}
+for stage in [stage for stages in STAGES.values() for stage in stages]:
+    STAGE_INDEX.setdefault(normalize_stage(stage), stage.strip())
+
+STAGE_GROUPS = {group: {STAGE_INDEX[normalize_stage(stage)] for stage in stages} for group, stages in STAGES.items()}
+STAGE_DTYPE = pd.CategoricalDtype(list(dict.fromkeys(STAGE_INDEX.values())))
+
+def map_stages(stages):
+    # Un solo passaggio sui valori distinti: gli stage non previsti da config.STAGES diventano NaN
+    mapping = {stage: STAGE_INDEX.get(normalize_stage(stage)) for stage in stages.dropna().unique()}
+    unmapped = sorted(str(stage) for stage, mapped in mapping.items() if mapped is None)
+
+    return stages.map(mapping).astype(STAGE_DTYPE), unmapped
+
+def sum_stage_group(totals, group):
+    return totals[totals.index.isin(STAGE_GROUPS[group])].sum()
 
 class BaseAnalyzer:
-    def __init__(self, start_date, end_date, comparison_start, comparison_end):
+    table_name = None
+    # Tabella scritta da save_to_database da cui derivano i dati letti (riepiloghi inclusi)
+    source_table = None
+    date_field = 'date'
+    columns = None
+    summary_columns = None
+
+    def __init__(self, start_date, end_date, comparison_start, comparison_end, detail=True):
         self.start_date = start_date
         self.end_date = end_date
         self.comparison_start = comparison_start
         self.comparison_end = comparison_end
+        # Senza il dettaglio per annuncio, età o keyword bastano i riepiloghi giornalieri
+        self.detail = detail or self.summary_columns is None
+
+    def get_filters(self):
+        return []
+
+    def load_data(self, start_date, end_date):
+        if not self.detail:
+            filters = [('source', '=', self.table_name.removesuffix("_data"))] + self.get_filters()
+            return get_data("daily_summary", start_date, end_date, columns=self.summary_columns, filters=filters)
+
+        return get_data(self.table_name, start_date, end_date, custom_date_field=self.date_field, columns=self.columns, filters=self.get_filters())
+
+    def load_periods(self):
+        # Periodo di confronto e corrente sono adiacenti: una sola query sull'intervallo
+        # complessivo, poi ogni riga viene etichettata con il proprio periodo
+        df = self.load_data(self.comparison_start, self.end_date)
+        df['period'] = (df[self.date_field] >= pd.Timestamp(self.start_date)).map({True: 'current', False: 'comparison'})
+
+        return df
+
+    def split_periods(self, df):
+        periods = {period: group.drop(columns='period') for period, group in df.groupby('period')}
+        empty = df.iloc[0:0].drop(columns='period')
+
+        return periods.get('current', empty), periods.get('comparison', empty)
+
+    def clean_data(self, df):
+        return df
+
+    def cache_key(self):
+        # La versione dei dati cambia a ogni scrittura: dopo un aggiornamento la chiave è nuova
+        return (type(self).__name__, self.start_date, self.end_date, self.comparison_start, self.comparison_end,
+                self.detail, getattr(self, 'update_type', None), repr(self.get_filters()),
+                get_data_versions([self.source_table or self.table_name]))
+
+    def get_daily_measures(self, df):
+        # Nome del risultato -> (colonna della serie, valore di ogni riga)
+        return {}
+
+    def daily_series(self, df):
+        # Tutte le misure giornaliere dei due periodi con un solo groupby, riportato sul calendario
+        # completo: corrente e confronto escono allineati giorno per giorno, senza merge per serie
+        measures = self.get_daily_measures(df)
+        if not measures:
+            return {}, {}
+
+        values = pd.DataFrame({name: series for name, (_, series) in measures.items()})
+        calendar = pd.date_range(start=self.comparison_start, end=self.end_date, normalize=True)
+        daily = values.groupby(df[self.date_field].dt.normalize()).sum().reindex(calendar, fill_value=0)
+
+        def window(start, end):
+            days = daily.loc[pd.Timestamp(start).normalize():pd.Timestamp(end).normalize()]
+            return {name: pd.DataFrame({'date': days.index, column: days[name].to_numpy()}) for name, (column, _) in measures.items()}
+
+        return window(self.start_date, self.end_date), window(self.comparison_start, self.comparison_end)
+
+    def compute(self):
+        df = self.clean_data(self.load_periods())
+        df_current, df_comp = self.split_periods(df)
+
+        results = self.aggregate_results(df_current)
+        results_comp = self.aggregate_results(df_comp, is_comparison=True)
+        daily, daily_comp = self.daily_series(df)
+
+        return {**results, **daily}, {**results_comp, **daily_comp}
+
+    def analyze(self):
+        return cached(self.cache_key(), self.compute)
 
 class MetaAnalyzer(BaseAnalyzer):
-    def __init__(self, start_date, end_date, comparison_start, comparison_end):
-        super().__init__(start_date, end_date, comparison_start, comparison_end)
+    table_name = "facebook_data"
+    columns = ['date', 'campaign', 'adset_name', 'adset_status', 'ad_name', 'status', 'link', 'age',
+               'spend', 'impressions', 'outbound_clicks_outbound_click', 'actions_lead', 'actions_purchase']
+    summary_columns = ['date', 'campaign', 'spend', 'impressions', 'clicks']
+
+    def __init__(self, start_date, end_date, comparison_start, comparison_end, detail=True):
+        super().__init__(start_date, end_date, comparison_start, comparison_end, detail)
     
-    def clean_data(self, df):
+    def get_filters(self):
         env = environ.Env()
         environ.Env.read_env()
 
-        return df.loc[
-            (df["account_id"] == env('facebook_account_id')) &
-            (~df["campaign"].str.contains(r"Ricerca figure")) &
-            (~df["campaign"].str.contains(r"DENTALAI"))
+        return [
+            ('account_id', '=', env('facebook_account_id')),
+            ('campaign', 'NOT GLOB', '*Ricerca figure*'),
+            ('campaign', 'NOT GLOB', '*DENTALAI*')
         ]
+
+    def get_daily_measures(self, df):
+        return {'spesa_giornaliera': ('spend', df['spend'])}
     
     def aggregate_results(self, df, is_comparison=False):
         aggregate_results = {
@@ -33,14 +141,15 @@ class MetaAnalyzer(BaseAnalyzer):
             'end_date': self.comparison_end if is_comparison else self.end_date,
             'spesa_totale': df["spend"].sum(),
             'impression': df["impressions"].sum(),
-            'click': df["outbound_clicks_outbound_click"].sum(),
-            'campagne_attive': df["campaign"].nunique(),
-            'spesa_giornaliera': df.groupby('date')['spend'].sum().reset_index(),
-            'dettaglio_campagne': self.get_campaign_details(df),
-            'dettaglio_ad': self.get_ad_details(df),
-            'age_data': self.get_age_data(df)
+            'click': df["outbound_clicks_outbound_click" if self.detail else "clicks"].sum(),
+            'campagne_attive': df["campaign"].nunique()
         }
 
+        if self.detail:
+            aggregate_results['dettaglio_campagne'] = self.get_campaign_details(df)
+            aggregate_results['dettaglio_ad'] = self.get_ad_details(df)
+            aggregate_results['age_data'] = self.get_age_data(df)
+
         for r in [aggregate_results]:
             r['cpm'] = r['spesa_totale'] / r['impression'] * 1000 if r['impression'] != 0 else 0
             r['ctr'] = (r['click'] / r['impression']) * 100 if r['impression'] != 0 else 0
@@ -48,19 +157,8 @@ class MetaAnalyzer(BaseAnalyzer):
         
         return aggregate_results
 
-    def analyze(self):
-        df_raw = get_data("facebook_data", self.start_date, self.end_date)
-        df_raw_comp = get_data("facebook_data", self.comparison_start, self.comparison_end)
-
-        df = self.clean_data(df_raw)
-        df_comp = self.clean_data(df_raw_comp)
-
-        results = self.aggregate_results(df)
-        results_comp = self.aggregate_results(df_comp, is_comparison=True)
-        return results, results_comp
-
     def get_age_data(self, df):
-        return df.groupby('age').agg({
+        return df.groupby('age', observed=True).agg({
             'spend': 'sum',
             'impressions': 'sum',
             'outbound_clicks_outbound_click': 'sum',
@@ -69,7 +167,7 @@ class MetaAnalyzer(BaseAnalyzer):
         }).reset_index()
     
     def get_campaign_details(self, df):
-        dettaglioCampagne = df.groupby('adset_name').agg({
+        dettaglioCampagne = df.groupby('adset_name', observed=True).agg({
             'campaign': lambda x: x.iloc[0],
             'adset_status': lambda x: x.iloc[0],
             'spend': 'sum',
@@ -100,7 +198,7 @@ class MetaAnalyzer(BaseAnalyzer):
         return dettaglioCampagne
     
     def get_ad_details(self, df):
-        dettaglioAd = df.groupby('ad_name').agg({
+        dettaglioAd = df.groupby('ad_name', observed=True).agg({
             'campaign': lambda x: x.iloc[0],
             'adset_name': lambda x: x.iloc[0],
             'status': lambda x: x.iloc[0],
@@ -138,16 +236,23 @@ class MetaAnalyzer(BaseAnalyzer):
         return dettaglioAd
 
 class GadsAnalyzer(BaseAnalyzer):
-    def __init__(self, start_date, end_date, comparison_start, comparison_end):
-        super().__init__(start_date, end_date, comparison_start, comparison_end)
+    table_name = "google_ads_data"
+    columns = ['date', 'campaign', 'keyword_text', 'spend', 'impressions', 'clicks']
+    summary_columns = ['date', 'campaign', 'spend', 'impressions', 'clicks']
+
+    def __init__(self, start_date, end_date, comparison_start, comparison_end, detail=True):
+        super().__init__(start_date, end_date, comparison_start, comparison_end, detail)
     
-    def clean_data(self, df):
+    def get_filters(self):
         env = environ.Env()
         environ.Env.read_env()
 
-        return df.loc[
-            (df["account_id"] == env('google_ads_account_id'))
+        return [
+            ('account_id', '=', env('google_ads_account_id'))
         ]
+
+    def get_daily_measures(self, df):
+        return {'spesa_giornaliera': ('spend', df['spend'])}
     
     def aggregate_results(self, df, is_comparison=False):
         aggregate_results = {
@@ -157,11 +262,12 @@ class GadsAnalyzer(BaseAnalyzer):
             'impression': df["impressions"].sum(),
             'click': df["clicks"].sum(),
             'campagne_attive': df["campaign"].nunique(),
-            'spesa_giornaliera': df.groupby('date')['spend'].sum().reset_index(),
-            'dettaglio_campagne': self.get_campaign_details(df),
-            'dettaglio_keyword': self.get_keyword_details(df)
+            'dettaglio_campagne': self.get_campaign_details(df)
         }
 
+        if self.detail:
+            aggregate_results['dettaglio_keyword'] = self.get_keyword_details(df)
+
         for r in [aggregate_results]:
             r['cpm'] = r['spesa_totale'] / r['impression'] * 1000 if r['impression'] != 0 else 0
             r['ctr'] = (r['click'] / r['impression']) * 100 if r['impression'] != 0 else 0
@@ -169,19 +275,8 @@ class GadsAnalyzer(BaseAnalyzer):
         
         return aggregate_results
 
-    def analyze(self):
-        df_raw = get_data("google_ads_data", self.start_date, self.end_date)
-        df_raw_comp = get_data("google_ads_data", self.comparison_start, self.comparison_end)
-        
-        df = self.clean_data(df_raw)
-        df_comp = self.clean_data(df_raw_comp)
-
-        results = self.aggregate_results(df)
-        results_comp = self.aggregate_results(df_comp, is_comparison=True)
-        return results, results_comp
-    
     def get_campaign_details(self, df):
-        dettaglioCampagne = df.groupby('campaign').agg({
+        dettaglioCampagne = df.groupby('campaign', observed=True).agg({
             'spend': 'sum',
             'impressions': 'sum',
             'clicks': 'sum'
@@ -200,7 +295,7 @@ class GadsAnalyzer(BaseAnalyzer):
         return dettaglioCampagne
 
     def get_keyword_details(self, df):
-        dettaglioKeyword = df.groupby('keyword_text').agg({
+        dettaglioKeyword = df.groupby('keyword_text', observed=True).agg({
             'spend': 'sum',
             'impressions': 'sum',
             'clicks': 'sum'
@@ -219,16 +314,24 @@ class GadsAnalyzer(BaseAnalyzer):
         return dettaglioKeyword
 
 class TikTokAnalyzer(BaseAnalyzer):
-    def __init__(self, start_date, end_date, comparison_start, comparison_end):
-        super().__init__(start_date, end_date, comparison_start, comparison_end)
+    table_name = "tiktok_data"
+    columns = ['date', 'campaign', 'ad_group_name', 'ad_group_operation_status', 'spend', 'impressions', 'clicks',
+               'total_sales_lead', 'total_purchase']
+    summary_columns = ['date', 'campaign', 'spend', 'impressions', 'clicks']
+
+    def __init__(self, start_date, end_date, comparison_start, comparison_end, detail=True):
+        super().__init__(start_date, end_date, comparison_start, comparison_end, detail)
     
-    def clean_data(self, df):
+    def get_filters(self):
         env = environ.Env()
         environ.Env.read_env()
 
-        return df.loc[
-            (df["account_id"] == env('tiktok_account_id'))
+        return [
+            ('account_id', '=', env('tiktok_account_id'))
         ]
+
+    def get_daily_measures(self, df):
+        return {'spesa_giornaliera': ('spend', df['spend'])}
     
     def aggregate_results(self, df, is_comparison=False):
         aggregate_results = {
@@ -237,11 +340,12 @@ class TikTokAnalyzer(BaseAnalyzer):
             'spesa_totale': df["spend"].sum(),
             'impression': df["impressions"].sum(),
             'click': df["clicks"].sum(),
-            'campagne_attive': df["campaign"].nunique(),
-            'spesa_giornaliera': df.groupby('date')['spend'].sum().reset_index(),
-            'dettaglio_campagne': self.get_campaign_details(df)
+            'campagne_attive': df["campaign"].nunique()
         }
 
+        if self.detail:
+            aggregate_results['dettaglio_campagne'] = self.get_campaign_details(df)
+
         for r in [aggregate_results]:
             r['cpm'] = r['spesa_totale'] / r['impression'] * 1000 if r['impression'] != 0 else 0
             r['ctr'] = (r['click'] / r['impression']) * 100 if r['impression'] != 0 else 0
@@ -249,19 +353,8 @@ class TikTokAnalyzer(BaseAnalyzer):
         
         return aggregate_results
 
-    def analyze(self):
-        df_raw = get_data("tiktok_data", self.start_date, self.end_date)
-        df_raw_comp = get_data("tiktok_data", self.comparison_start, self.comparison_end)
-
-        df = self.clean_data(df_raw)
-        df_comp = self.clean_data(df_raw_comp)
-
-        results = self.aggregate_results(df)
-        results_comp = self.aggregate_results(df_comp, is_comparison=True)
-        return results, results_comp
-
     def get_campaign_details(self, df):
-        dettaglioCampagne = df.groupby('ad_group_name').agg({
+        dettaglioCampagne = df.groupby('ad_group_name', observed=True).agg({
             'campaign': lambda x: x.iloc[0],
             'ad_group_operation_status': lambda x: x.iloc[0],
             'spend': 'sum',
@@ -292,16 +385,23 @@ class TikTokAnalyzer(BaseAnalyzer):
         return dettaglioCampagne
 
 class GanalyticsAnalyzer(BaseAnalyzer):
-    def __init__(self, start_date, end_date, comparison_start, comparison_end):
-        super().__init__(start_date, end_date, comparison_start, comparison_end)
+    table_name = "googleanalytics4_data"
+    columns = ['date', 'campaign', 'source', 'sessions', 'engaged_sessions', 'active_users', 'user_engagement_duration']
+    summary_columns = ['date', 'campaign', 'sessions', 'engaged_sessions', 'active_users', 'user_engagement_duration']
+
+    def __init__(self, start_date, end_date, comparison_start, comparison_end, detail=True):
+        super().__init__(start_date, end_date, comparison_start, comparison_end, detail)
     
-    def clean_data(self, df):
+    def get_filters(self):
         env = environ.Env()
         environ.Env.read_env()
 
-        return df.loc[
-            (df["account_id"] == env('googleanalytics4_account_id'))
+        return [
+            ('account_id', '=', env('googleanalytics4_account_id'))
         ]
+
+    def get_daily_measures(self, df):
+        return {'utenti_attivi_giornalieri': ('active_users', df['active_users'])}
     
     def aggregate_results(self, df, is_comparison=False):
         aggregate_results = {
@@ -311,11 +411,12 @@ class GanalyticsAnalyzer(BaseAnalyzer):
             'sessioni': df["sessions"].sum(),
             'sessioni_con_engage': df["engaged_sessions"].sum(),
             'durata_engagement': df["user_engagement_duration"].sum(),
-            'utenti_attivi_giornalieri': df.groupby('date')['active_users'].sum().reset_index(),
-            'sessioni_distribuzione': self.get_session_distribution(df),
             'campagne_distribuzione': self.get_campaign_distribution(df)
         }
 
+        if self.detail:
+            aggregate_results['sessioni_distribuzione'] = self.get_session_distribution(df)
+
         for r in [aggregate_results]:
             r['sessioni_per_utente'] = r['sessioni'] / r['utenti_attivi'] if r['utenti_attivi'] != 0 else 0
             r['durata_sessioni'] = r['durata_engagement'] / r['sessioni'] if r['sessioni'] != 0 else 0
@@ -324,17 +425,6 @@ class GanalyticsAnalyzer(BaseAnalyzer):
         
         return aggregate_results
 
-    def analyze(self):
-        df_raw = get_data("googleanalytics4_data", self.start_date, self.end_date)
-        df_raw_comp = get_data("googleanalytics4_data", self.comparison_start, self.comparison_end)
-        
-        df = self.clean_data(df_raw)
-        df_comp = self.clean_data(df_raw_comp)
-
-        results = self.aggregate_results(df)
-        results_comp = self.aggregate_results(df_comp, is_comparison=True)
-        return results, results_comp
-    
     def get_session_distribution(self, df):
         google = df[df['source'].str.contains('google') & ~df['source'].str.contains('googleads')]
         google_ads = df[df['source'].str.contains('googleads')]
@@ -362,7 +452,7 @@ class GanalyticsAnalyzer(BaseAnalyzer):
         return session_df
     
     def get_campaign_distribution(self, df):
-        campaign_sessions = df.groupby('campaign')['sessions'].sum().reset_index()
+        campaign_sessions = df.groupby('campaign', observed=True)['sessions'].sum().reset_index()
 
         total_campaign_sessions = campaign_sessions['sessions'].sum()
         campaign_sessions['percentage'] = campaign_sessions['sessions'].div(total_campaign_sessions).fillna(0).mul(100)
@@ -370,33 +460,55 @@ class GanalyticsAnalyzer(BaseAnalyzer):
         return campaign_sessions
 
 class OppAnalyzer(BaseAnalyzer):
+    # Ogni riga del riepilogo conta le opportunità di un giorno per stage e venditore
+    table_name = "opp_daily_summary"
+    source_table = "opp_data"
+    columns = ['date', 'stage', 'venditore', 'opportunities', 'monetaryValue']
+
     def __init__(self, start_date, end_date, comparison_start, comparison_end, update_type):
         super().__init__(start_date, end_date, comparison_start, comparison_end)
         self.update_type = update_type
     
-    def clean_data(self, df, is_comparison=False):
-        df[self.update_type] = pd.to_datetime(df[self.update_type])
+    def get_filters(self):
+        return [
+            ('date_field', '=', self.update_type)
+        ]
+
+    def get_daily_measures(self, df):
+        qualificati = df['stage'].isin(STAGE_GROUPS['qualificati'])
+        vinti = df['stage'].isin(STAGE_GROUPS['vinti'])
+
+        return {
+            'lead_qualificati_giorno': ('count', df['opportunities'].where(qualificati, 0)),
+            'vinti_giorno': ('count', df['opportunities'].where(vinti, 0)),
+            'opp_per_giorno': ('count', df['opportunities']),
+            'incasso_giorno': ('count', df['monetaryValue'].where(vinti, 0))
+        }
+
+    def clean_data(self, df):
+        df['stage'], self.unmapped_stages = map_stages(df['stage'])
 
         return df
-    
+
     def aggregate_results(self, df, is_comparison=False):
+        # Opportunità e valore per stage in un solo groupby: i gruppi di STAGES si sommano sui totali
+        totals = df.groupby('stage', observed=True)[['opportunities', 'monetaryValue']].sum()
+        opportunities = totals['opportunities']
+
         aggregate_results = {
             'start_date': self.comparison_start if is_comparison else self.start_date,
             'end_date': self.comparison_end if is_comparison else self.end_date,
-            'totali': len(df),
-            'lead_da_qualificare': df[df['stage'].isin(STAGES['daQualificare'])].shape[0],
-            'lead_qualificati': df[df['stage'].isin(STAGES['qualificati'])].shape[0],
-            'vendite': df[df['stage'].isin(STAGES['vinti'])].shape[0],
-            'opportunità_perse': self.get_opportunità_perse(df),
-            'setting_persi': df[df['stage'].isin(STAGES['leadPersi'])].shape[0],
-            'vendite_gestione': df[df['stage'].isin(STAGES['venditeGestione'])].shape[0],
-            'vendite_da_chiudere': df[df['stage'].isin(STAGES['venditeChiusura'])].shape[0],
-            'persi': df[df['stage'].isin(STAGES['persi'])].shape[0],
-            'lead_qualificati_giorno': self.lead_qualificati_giorno(df, is_comparison),
-            'vinti_giorno': self.vinti_giorno(df, is_comparison),
-            'opp_per_giorno': self.opp_per_giorno(df, is_comparison),
-            'incasso': df[df['stage'].isin(STAGES['vinti'])]['monetaryValue'].sum(),
-            'incasso_giorno': self.incasso_giorno(df, is_comparison),
+            'totali': df['opportunities'].sum(),
+            'lead_da_qualificare': sum_stage_group(opportunities, 'daQualificare'),
+            'lead_qualificati': sum_stage_group(opportunities, 'qualificati'),
+            'vendite': sum_stage_group(opportunities, 'vinti'),
+            'opportunità_perse': self.get_opportunità_perse(opportunities),
+            'setting_persi': sum_stage_group(opportunities, 'leadPersi'),
+            'vendite_gestione': sum_stage_group(opportunities, 'venditeGestione'),
+            'vendite_da_chiudere': sum_stage_group(opportunities, 'venditeChiusura'),
+            'persi': sum_stage_group(opportunities, 'persi'),
+            'stage_non_mappati': self.unmapped_stages,
+            'incasso': sum_stage_group(totals['monetaryValue'], 'vinti'),
             'venditori': df['venditore'].unique().tolist(),
             'vendite_venditore': self.get_vendite_per_venditore(df)
         }
@@ -411,104 +523,18 @@ class OppAnalyzer(BaseAnalyzer):
         
         return aggregate_results
 
-    def analyze(self):
-        df_raw = get_data("opp_data", self.start_date, self.end_date, custom_date_field=self.update_type)
-        df_raw_comp = get_data("opp_data", self.comparison_start, self.comparison_end, custom_date_field=self.update_type)
-
-        df = self.clean_data(df_raw)
-        df_comp = self.clean_data(df_raw_comp)
-
-        results = self.aggregate_results(df)
-        results_comp = self.aggregate_results(df_comp, is_comparison=True)
-
-        return results, results_comp
-
-    def get_opportunità_perse(self, df):
-        opportunitàPerStage = df['stage'].value_counts()
-        
+    def get_opportunità_perse(self, opportunitàPerStage):
         opportunitàPerse = STAGES['leadPersi'] + STAGES['persi']
         filtered_counts = {stage: opportunitàPerStage.get(stage, 0) for stage in opportunitàPerse}
         return pd.DataFrame(list(filtered_counts.items()), columns=['Stage', 'Opportunità'])
     
-    def lead_qualificati_giorno(self, df, is_comparison=False):
-        start = self.comparison_start if is_comparison else self.start_date
-        end = self.comparison_end if is_comparison else self.end_date
-
-        date_range = pd.date_range(start=start, end=end)
-        lead_qualificati_giorno = pd.DataFrame({'date': date_range})
-
-        lead_counts = df[df['stage'].isin(STAGES['qualificati'])].groupby(df[self.update_type].dt.date).size().reset_index(name='count')
-        lead_counts.columns = ['date', 'count']
-        lead_counts['date'] = pd.to_datetime(lead_counts['date'])
-
-        lead_qualificati_giorno['date'] = pd.to_datetime(lead_qualificati_giorno['date'])
-
-        lead_qualificati_giorno = lead_qualificati_giorno.merge(lead_counts, on='date', how='left')
-        lead_qualificati_giorno['count'] = lead_qualificati_giorno['count'].fillna(0)
-
-        return lead_qualificati_giorno
-
-    def vinti_giorno(self, df, is_comparison=False):
-        start = self.comparison_start if is_comparison else self.start_date
-        end = self.comparison_end if is_comparison else self.end_date
-
-        date_range = pd.date_range(start=start, end=end)
-        vinti_giorno = pd.DataFrame({'date': date_range})
-
-        vinti_counts = df[df['stage'].isin(STAGES['vinti'])].groupby(df[self.update_type].dt.date).size().reset_index(name='count')
-        vinti_counts.columns = ['date', 'count']
-        vinti_counts['date'] = pd.to_datetime(vinti_counts['date'])
-
-        vinti_giorno['date'] = pd.to_datetime(vinti_giorno['date'])
-
-        vinti_giorno = vinti_giorno.merge(vinti_counts, on='date', how='left')
-        vinti_giorno['count'] = vinti_giorno['count'].fillna(0)
-
-        return vinti_giorno
-    
-    def opp_per_giorno(self, df, is_comparison=False):
-        start = self.comparison_start if is_comparison else self.start_date
-        end = self.comparison_end if is_comparison else self.end_date
-
-        date_range = pd.date_range(start=start, end=end)
-        opp_per_giorno = pd.DataFrame({'date': date_range})
-
-        opp_counts = df.groupby(df[self.update_type].dt.date).size().reset_index(name='count')
-        opp_counts.columns = ['date', 'count']
-        opp_counts['date'] = pd.to_datetime(opp_counts['date'])
-
-        opp_per_giorno['date'] = pd.to_datetime(opp_per_giorno['date'])
-
-        opp_per_giorno = opp_per_giorno.merge(opp_counts, on='date', how='left')
-        opp_per_giorno['count'] = opp_per_giorno['count'].fillna(0)
-
-        return opp_per_giorno
-
-    def incasso_giorno(self, df, is_comparison=False):
-        start = self.comparison_start if is_comparison else self.start_date
-        end = self.comparison_end if is_comparison else self.end_date
-
-        date_range = pd.date_range(start=start, end=end)
-        incasso_giorno = pd.DataFrame({'date': date_range})
-
-        incasso_counts = df[df['stage'].isin(STAGES['vinti'])]['monetaryValue'].groupby(df[self.update_type].dt.date).sum().reset_index(name='count')
-        incasso_counts.columns = ['date', 'count']
-        incasso_counts['date'] = pd.to_datetime(incasso_counts['date'])
-
-        incasso_giorno['date'] = pd.to_datetime(incasso_giorno['date'])
-
-        incasso_giorno = incasso_giorno.merge(incasso_counts, on='date', how='left')
-        incasso_giorno['count'] = incasso_giorno['count'].fillna(0)
-
-        return incasso_giorno
-
     def get_vendite_per_venditore(self, df):
         venditori = COMMERCIALI['venditori']
         vendite_list = []
 
         for venditore in venditori:
-            vendite = df[(df['stage'].isin(STAGES['vinti'])) & (df['venditore'] == venditore)]
-            num_vendite = vendite.shape[0]
+            vendite = df[(df['stage'].isin(STAGE_GROUPS['vinti'])) & (df['venditore'] == venditore)]
+            num_vendite = vendite['opportunities'].sum()
             valore_totale = vendite['monetaryValue'].sum()
 
             venditore_data = {
@@ -527,84 +553,73 @@ class OppAnalyzer(BaseAnalyzer):
         return vendite_venditore
 
 class AttributionAnalyzer(BaseAnalyzer):
+    table_name = "attribution_data"
+    # Suffisso delle chiavi dei risultati e gruppo di stage di config.STAGES
+    stage_groups = {
+        '': 'stages',
+        '_da_qualificare': 'daQualificare',
+        '_qualificati': 'qualificati',
+        '_lead_persi': 'leadPersi',
+        '_vendite_gestione': 'venditeGestione',
+        '_vendite_da_chiudere': 'venditeChiusura',
+        '_vinti': 'vinti',
+        '_persi': 'persi'
+    }
+
     def __init__(self, start_date, end_date, comparison_start, comparison_end, update_type):
         super().__init__(start_date, end_date, comparison_start, comparison_end)
         self.update_type = update_type
-    
-    def clean_data(self, df, is_comparison=False):
-        df["createdAt"] = pd.to_datetime(df["createdAt"])
-        df["lastStageChangeAt"] = pd.to_datetime(df["lastStageChangeAt"])
-        df["data_acquisizione"] = pd.to_datetime(df["data_acquisizione"], errors='coerce')
-        df["data_acquisizione"] = df["data_acquisizione"].fillna(pd.NaT)
-        df["createdAt"] = df["createdAt"].dt.strftime('%d-%m-%Y')
-        df["lastStageChangeAt"] = df["lastStageChangeAt"].dt.strftime('%d-%m-%Y')
-        df["data_acquisizione"] = pd.to_datetime(df["data_acquisizione"]).dt.strftime('%d-%m-%Y')
-
-        df = df.loc[
-            (df['pipeline_stage_name'].isin(STAGES['stages'])) &
-            (df['fonte'].notna())
+        self.date_field = update_type
+        self.columns = [update_type, 'fonte', 'pipeline_stage_name']
+
+    def get_filters(self):
+        return [
+            ('fonte', 'IS NOT NULL', None)
         ]
 
-        return df
+    def clean_data(self, df):
+        # Solo gli stage della pipeline di config.STAGES, riconosciuti anche con spazi diversi
+        df['pipeline_stage_name'], self.unmapped_stages = map_stages(df['pipeline_stage_name'])
+
+        return df.dropna(subset=['pipeline_stage_name'])
     
     def aggregate_results(self, df, is_comparison=False):
+        # Un solo conteggio per fonte e stage: i gruppi di stage si sommano sul risultato, non sulle righe
+        counts = df.groupby(['fonte', 'pipeline_stage_name'], observed=True, sort=False).size()
+        by_source = counts.groupby(level='fonte', observed=True, sort=False).sum()
+
         aggregate_results = {
             'start_date': self.comparison_start if is_comparison else self.start_date,
             'end_date': self.comparison_end if is_comparison else self.end_date,
             'totali': len(df),
-            'lead_fonti': df['fonte'].unique().tolist(),
-            **{fonte: df[df['fonte'] == fonte].shape[0] for fonte in df['fonte'].unique()},
-            'lead_meta': df[(df['fonte'] == 'Facebook Ads') & (df['pipeline_stage_name'].isin(STAGES['stages']))].shape[0],
-            'lead_meta_da_qualificare': df[(df['fonte'] == 'Facebook Ads') & (df['pipeline_stage_name'].isin(STAGES['daQualificare']))].shape[0],
-            'lead_meta_qualificati': df[(df['fonte'] == 'Facebook Ads') & (df['pipeline_stage_name'].isin(STAGES['qualificati']))].shape[0],
-            'lead_meta_lead_persi': df[(df['fonte'] == 'Facebook Ads') & (df['pipeline_stage_name'].isin(STAGES['leadPersi']))].shape[0],
-            'lead_meta_vendite_gestione': df[(df['fonte'] == 'Facebook Ads') & (df['pipeline_stage_name'].isin(STAGES['venditeGestione']))].shape[0],
-            'lead_meta_vendite_da_chiudere': df[(df['fonte'] == 'Facebook Ads') & (df['pipeline_stage_name'].isin(STAGES['venditeChiusura']))].shape[0],
-            'lead_meta_vinti': df[(df['fonte'] == 'Facebook Ads') & (df['pipeline_stage_name'].isin(STAGES['vinti']))].shape[0],
-            'lead_meta_persi': df[(df['fonte'] == 'Facebook Ads') & (df['pipeline_stage_name'].isin(STAGES['persi']))].shape[0],
-            'lead_google': df[(df['fonte'] == 'Google Ads') & (df['pipeline_stage_name'].isin(STAGES['stages']))].shape[0],
-            'lead_google_da_qualificare': df[(df['fonte'] == 'Google Ads') & (df['pipeline_stage_name'].isin(STAGES['daQualificare']))].shape[0],
-            'lead_google_qualificati': df[(df['fonte'] == 'Google Ads') & (df['pipeline_stage_name'].isin(STAGES['qualificati']))].shape[0],
-            'lead_google_lead_persi': df[(df['fonte'] == 'Google Ads') & (df['pipeline_stage_name'].isin(STAGES['leadPersi']))].shape[0],
-            'lead_google_vendite_gestione': df[(df['fonte'] == 'Google Ads') & (df['pipeline_stage_name'].isin(STAGES['venditeGestione']))].shape[0],
-            'lead_google_vendite_da_chiudere': df[(df['fonte'] == 'Google Ads') & (df['pipeline_stage_name'].isin(STAGES['venditeChiusura']))].shape[0],
-            'lead_google_vinti': df[(df['fonte'] == 'Google Ads') & (df['pipeline_stage_name'].isin(STAGES['vinti']))].shape[0],
-            'lead_google_persi': df[(df['fonte'] == 'Google Ads') & (df['pipeline_stage_name'].isin(STAGES['persi']))].shape[0],
-            'lead_tiktok': df[(df['fonte'] == 'Tiktok Ads') & (df['pipeline_stage_name'].isin(STAGES['stages']))].shape[0],
-            'lead_tiktok_da_qualificare': df[(df['fonte'] == 'Tiktok Ads') & (df['pipeline_stage_name'].isin(STAGES['daQualificare']))].shape[0],
-            'lead_tiktok_qualificati': df[(df['fonte'] == 'Tiktok Ads') & (df['pipeline_stage_name'].isin(STAGES['qualificati']))].shape[0],
-            'lead_tiktok_lead_persi': df[(df['fonte'] == 'Tiktok Ads') & (df['pipeline_stage_name'].isin(STAGES['leadPersi']))].shape[0],
-            'lead_tiktok_vendite_gestione': df[(df['fonte'] == 'Tiktok Ads') & (df['pipeline_stage_name'].isin(STAGES['venditeGestione']))].shape[0],
-            'lead_tiktok_vendite_da_chiudere': df[(df['fonte'] == 'Tiktok Ads') & (df['pipeline_stage_name'].isin(STAGES['venditeChiusura']))].shape[0],
-            'lead_tiktok_vinti': df[(df['fonte'] == 'Tiktok Ads') & (df['pipeline_stage_name'].isin(STAGES['vinti']))].shape[0],
-            'lead_tiktok_persi': df[(df['fonte'] == 'Tiktok Ads') & (df['pipeline_stage_name'].isin(STAGES['persi']))].shape[0]
+            'lead_fonti': by_source.index.tolist(),
+            **{fonte: int(total) for fonte, total in by_source.items()},
+            'stage_non_mappati': self.unmapped_stages
         }
-        
-        return aggregate_results
 
-    def analyze(self):
-        df_raw = get_data("attribution_data", self.start_date, self.end_date, custom_date_field=self.update_type)
-        df_raw_comp = get_data("attribution_data", self.comparison_start, self.comparison_end, custom_date_field=self.update_type)
-        
-        df = self.clean_data(df_raw)
-        df_comp = self.clean_data(df_raw_comp)
+        for prefix, fonte in ATTRIBUTION_SOURCES.items():
+            stages = counts.xs(fonte, level='fonte') if fonte in by_source.index else counts.iloc[0:0].droplevel('fonte')
 
-        results = self.aggregate_results(df)
-        results_comp = self.aggregate_results(df_comp, is_comparison=True)
-
-        return results, results_comp
+            for suffix, group in self.stage_groups.items():
+                aggregate_results[f"lead_{prefix}{suffix}"] = int(sum_stage_group(stages, group))
+        
+        return aggregate_results
 
 class TransactionAnalyzer(BaseAnalyzer):
-    def __init__(self, start_date, end_date, comparison_start, comparison_end):
-        super().__init__(start_date, end_date, comparison_start, comparison_end)
-    
-    def clean_data(self, df, is_comparison=False):
-        df["date"] = pd.to_datetime(df["date"])
+    table_name = "transaction_data"
+    columns = ['date', 'total']
 
-        return df.loc[
-            (df["status"] == "succeeded")
-        ]
+    def __init__(self, start_date, end_date, comparison_start, comparison_end, detail=True):
+        super().__init__(start_date, end_date, comparison_start, comparison_end, detail)
     
+    def get_filters(self):
+        return [
+            ('status', '=', 'succeeded')
+        ]
+
+    def get_daily_measures(self, df):
+        return {'incasso_giorno': ('count', df['total'])}
+
     def aggregate_results(self, df, is_comparison=False):
         aggregate_results = {
             'start_date': self.comparison_start if is_comparison else self.start_date,
@@ -613,38 +628,7 @@ class TransactionAnalyzer(BaseAnalyzer):
             'transazioni': df['total'].sum(),
             'prove_gratuite': df[df['total'] == 0].shape[0],
             'abbonamenti_mensili': df[(df['total'] > 0) & (df['total'] < 500)].shape[0],
-            'abbonamenti_annuali': df[df['total'] > 500].shape[0],
-            'incasso_giorno': self.incasso_giorno(df, is_comparison)
+            'abbonamenti_annuali': df[df['total'] > 500].shape[0]
         }
         
         return aggregate_results
-
-    def analyze(self):
-        df_raw = get_data("transaction_data", self.start_date, self.end_date, custom_date_field="date")
-        df_raw_comp = get_data("transaction_data", self.comparison_start, self.comparison_end, custom_date_field="date")
-
-        df = self.clean_data(df_raw)
-        df_comp = self.clean_data(df_raw_comp)
-
-        results = self.aggregate_results(df)
-        results_comp = self.aggregate_results(df_comp, is_comparison=True)
-
-        return results, results_comp
-    
-    def incasso_giorno(self, df, is_comparison=False):
-        start = self.comparison_start if is_comparison else self.start_date
-        end = self.comparison_end if is_comparison else self.end_date
-
-        date_range = pd.date_range(start=start, end=end)
-        incasso_giorno = pd.DataFrame({'date': date_range})
-
-        incasso_counts = df['total'].groupby(df['date'].dt.date).sum().reset_index(name='count')
-        incasso_counts.columns = ['date', 'count']
-        incasso_counts['date'] = pd.to_datetime(incasso_counts['date'])
-
-        incasso_giorno['date'] = pd.to_datetime(incasso_giorno['date'])
-
-        incasso_giorno = incasso_giorno.merge(incasso_counts, on='date', how='left')
-        incasso_giorno['count'] = incasso_giorno['count'].fillna(0)
-
-        return incasso_giorno
\ No newline at end of file
@@ -1,46 +1,306 @@
-import streamlit as st
 import environ
+import gzip
 import json
-from urllib.request import urlopen
+import re
+import codecs
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, timedelta
 import pandas as pd
 import mysql.connector
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
 
-from db import save_to_database
+from config import CUSTOM_FIELDS
+from http_client import stream, is_transient
+from metrics import timed, record as record_metrics
+from raw_cache import cache_response, cache_rows, iter_cached, read_cached_rows
+from db import save_to_database, get_sync_state, update_sync_state, get_high_water_mark, update_high_water_mark, get_completed_chunks, mark_chunk_completed, clear_completed_chunks, clear_stale_chunks
 
-def api_retrieving(data_source, fields, start_date, end_date):
+env = environ.Env()
+environ.Env.read_env()
+
+REFRESH_WORKERS = env.int('refresh_workers', default=4)
+SYNC_LOOKBACK_DAYS = env.int('sync_lookback_days', default=3)
+API_BATCH_SIZE = env.int('api_batch_size', default=5000)
+API_CHUNK_DAYS = env.int('api_chunk_days', default=7)
+API_CHUNK_WORKERS = env.int('api_chunk_workers', default=4)
+API_RETRIES = env.int('api_retries', default=4)
+CRM_BATCH_SIZE = env.int('crm_batch_size', default=5000)
+CRM_OPP_CHANGED_COLUMN = env('crm_opp_changed_column', default='updatedAt')
+CRM_PAYMENT_CHANGED_COLUMN = env('crm_payment_changed_column', default='updatedAt')
+READ_CHUNK_SIZE = 1 << 16
+
+DATA_ARRAY = re.compile(r'"data"\s*:\s*\[')
+
+def sync_account(table_name):
+    # Ogni fonte API ha il proprio account: cambiandolo si riparte da una finestra vuota
+    return env(f"{table_name.removesuffix('_data')}_account_id", default='')
+
+def sync_window(table_name, date_field, start_date, end_date, full_refresh=False):
+    # Solo per le fonti API, i cui dati di un giorno non cambiano più dopo qualche giorno: scarica
+    # i giorni non ancora sincronizzati più una finestra di look-back per le conversioni arrivate
+    # in ritardo. None se il periodo è già aggiornato.
+    state = None if full_refresh else get_sync_state(table_name, date_field, sync_account(table_name))
+    if state is None:
+        return start_date, end_date
+
+    synced_from, synced_to = state
+    if start_date < synced_from:
+        return start_date, end_date
+
+    fetch_start = max(start_date, synced_to - timedelta(days=SYNC_LOOKBACK_DAYS))
+    if fetch_start > end_date:
+        return None
+
+    return fetch_start, end_date
+
+def mark_synced(table_name, date_field, start_date, end_date):
+    account_id = sync_account(table_name)
+    state = get_sync_state(table_name, date_field, account_id)
+
+    # Le finestre contigue si fondono; una finestra staccata più vecchia non sostituisce quella corrente
+    if state:
+        synced_from, synced_to = state
+        if start_date <= synced_to + timedelta(days=1) and end_date >= synced_from - timedelta(days=1):
+            start_date, end_date = min(start_date, synced_from), max(end_date, synced_to)
+        elif end_date < synced_from:
+            return
+
+    update_sync_state(table_name, date_field, account_id, start_date, end_date)
+
+def split_date_range(start_date, end_date, chunk_days=API_CHUNK_DAYS):
+    chunks = []
+    while start_date <= end_date:
+        chunk_end = min(start_date + timedelta(days=chunk_days - 1), end_date)
+        chunks.append((start_date, chunk_end))
+        start_date = chunk_end + timedelta(days=1)
+
+    return chunks
+
+def missing_ranges(start_date, end_date, completed):
+    # Giorni del periodo non coperti da blocchi già completati, raggruppati in intervalli contigui:
+    # la ripresa funziona anche se il periodo o API_CHUNK_DAYS sono cambiati dal tentativo precedente
+    covered = set()
+    for chunk_start, chunk_end in completed:
+        covered.update(chunk_start + timedelta(days=offset) for offset in range((chunk_end - chunk_start).days + 1))
+
+    ranges, range_start, day = [], None, start_date
+    while day <= end_date:
+        if day in covered:
+            if range_start is not None:
+                ranges.append((range_start, day - timedelta(days=1)))
+                range_start = None
+        elif range_start is None:
+            range_start = day
+        day += timedelta(days=1)
+
+    if range_start is not None:
+        ranges.append((range_start, end_date))
+
+    return ranges
+
+def iter_json_records(stream, chunk_size=READ_CHUNK_SIZE, source=None):
+    # Legge l'array "data" un blocco alla volta senza caricare in memoria l'intera risposta
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder('utf-8')()
+    buffer, pos, in_array, closed = "", 0, False, False
+
+    while not closed:
+        with timed(source, 'network'):
+            chunk = stream.read(chunk_size)
+
+        with timed(source, 'parse'):
+            buffer = buffer[pos:] + text.decode(chunk, final=not chunk)
+            pos = 0
+
+            if not in_array:
+                match = DATA_ARRAY.search(buffer)
+                if match is None:
+                    if not chunk:
+                        return
+                    # Teniamo la coda: la chiave potrebbe essere spezzata tra due blocchi
+                    pos = max(0, len(buffer) - 64)
+                    continue
+                pos, in_array = match.end(), True
+
+            records = []
+            while True:
+                while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                    pos += 1
+                if pos < len(buffer) and buffer[pos] == ']':
+                    closed = True
+                    break
+                try:
+                    record, pos = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    # Record incompleto: serve il blocco successivo
+                    break
+                records.append(record)
+
+        yield from records
+
+        if not chunk and not closed:
+            raise ConnectionError("Risposta JSON troncata: l'array data non è stato chiuso")
+
+def api_retrieving(data_source, fields, start_date, end_date, batch_size=API_BATCH_SIZE):
     env = environ.Env()
     environ.Env.read_env()
 
-    url = f"{env('source')}{data_source}?api_key={env('api_key')}&date_from={start_date}&date_to={end_date}&fields={fields}&_renderer=json"
-    
-    with urlopen(url) as response:
-        data_json = json.load(response)
-    
-    df_raw = pd.json_normalize(data_json, record_path=["data"])
-    df_raw["date"] = pd.to_datetime(df_raw["date"]).dt.date
-    
+    params = {
+        'api_key': env('api_key'),
+        'date_from': start_date,
+        'date_to': end_date,
+        'fields': fields,
+        '_renderer': 'json'
+    }
+
+    # La chiave della cache esclude la api_key
+    cache_key = {name: value for name, value in params.items() if name != 'api_key'}
+    cache_meta = {'date_field': 'date', 'start_date': start_date, 'end_date': end_date}
+
+    with stream(f"{env('source')}{data_source}", params, label=f"{data_source}_data") as response, \
+            cache_response(f"{data_source}_data", cache_key, response, cache_meta) as body:
+        yield from record_batches(iter_json_records(body, source=f"{data_source}_data"), batch_size, f"{data_source}_data")
+
+def record_batches(records, batch_size=API_BATCH_SIZE, source=None):
+    # DataFrame di al più batch_size righe: la memoria resta costante qualunque sia l'ampiezza del periodo
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) == batch_size:
+            yield records_to_frame(batch, source)
+            batch = []
+
+    if batch:
+        yield records_to_frame(batch, source)
+
+def records_to_frame(records, source=None):
+    with timed(source, 'transform'):
+        df_raw = pd.json_normalize(records)
+        df_raw["date"] = pd.to_datetime(df_raw["date"]).dt.date
+
+    record_metrics(source, rows_read=len(df_raw))
+
     return df_raw
 
-def api_retrieve_data(source, fields, start_date, end_date):
+def api_retrieve_data(source, fields, start_date, end_date, full_refresh=False):
+    window = sync_window(f"{source}_data", 'date', start_date, end_date, full_refresh)
+    if window is None:
+        return None
+
+    # I giorni già scaricati da un aggiornamento fallito non vengono riscaricati; i blocchi
+    # fuori dal periodo corrente non servono più e vengono eliminati
+    account_id = sync_account(f"{source}_data")
+    if full_refresh:
+        clear_completed_chunks(f"{source}_data", account_id)
+    else:
+        clear_stale_chunks(f"{source}_data", account_id, *window)
+    completed = get_completed_chunks(f"{source}_data", account_id)
+    chunks = [chunk for missing in missing_ranges(*window, completed) for chunk in split_date_range(*missing)]
+
+    inserted, updated, errors = 0, 0, []
+    with ThreadPoolExecutor(max_workers=API_CHUNK_WORKERS) as executor:
+        futures = [executor.submit(api_retrieve_chunk, source, fields, *chunk) for chunk in chunks]
+
+        for future in as_completed(futures):
+            try:
+                chunk_inserted, chunk_updated = future.result()
+                inserted += chunk_inserted
+                updated += chunk_updated
+            except Exception as e:
+                errors.append(e)
+
+    if errors:
+        raise RuntimeError(f"{len(errors)} blocchi su {len(chunks)} non scaricati, verranno ripresi al prossimo aggiornamento: {errors[0]}") from errors[0]
+
+    mark_synced(f"{source}_data", 'date', *window)
+    clear_completed_chunks(f"{source}_data", account_id)
+
+    return inserted, updated
+
+@retry(retry=retry_if_exception(is_transient), stop=stop_after_attempt(API_RETRIES),
+       wait=wait_exponential(multiplier=2, max=60), reraise=True,
+       before_sleep=lambda retry_state: record_metrics(f"{retry_state.args[0]}_data", errors=1))
+def api_retrieve_chunk(source, fields, start_date, end_date):
+    # Un tentativo ripetuto riscrive le stesse righe: l'upsert lo rende innocuo
+    inserted, updated = 0, 0
+    for df in api_retrieving(source, fields, start_date, end_date):
+        batch_inserted, batch_updated = save_to_database(df, f"{source}_data", is_api=True)
+        inserted += batch_inserted
+        updated += batch_updated
+
+    mark_chunk_completed(f"{source}_data", sync_account(f"{source}_data"), start_date, end_date)
+
+    return inserted, updated
+
+def refresh_sources(tasks, max_workers=REFRESH_WORKERS):
+    # Le fonti attendono HTTP o MySQL: girano in parallelo e le scritture su SQLite
+    # vengono serializzate da save_to_database. Restituisce gli esiti man mano che arrivano.
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(task): label for label, task in tasks.items()}
+
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result(), None
+            except Exception as e:
+                yield futures[future], None, e
+
+def crm_retrieve_data(pool, query, table_name, transform, cache_meta, batch_size=CRM_BATCH_SIZE):
+    # Cursore non bufferizzato: le righe arrivano da MySQL a blocchi e ogni blocco
+    # viene trasformato e salvato mentre il server sta ancora inviando il resto
+    conn = pool.get_connection()
+    cursor = conn.cursor(buffered=False)
+
+    inserted, updated = 0, 0
     try:
-        df = api_retrieving(source, fields, start_date, end_date)
-        
+        cursor.execute(query)
+
+        with cache_rows(table_name, {'query': query}, cache_meta) as cache_batch:
+            while True:
+                with timed(table_name, 'network'):
+                    rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+
+                cache_batch(cursor.column_names, rows)
+                batch_inserted, batch_updated = save_to_database(crm_frame(rows, cursor.column_names, transform, table_name), table_name, is_api=False)
+                inserted += batch_inserted
+                updated += batch_updated
+    finally:
+        # Con un errore a metà (anche in scrittura su SQLite) le righe non lette vanno scartate prima
+        # di restituire la connessione; se non si riesce, il pool la scarta invece di riusarla
         try:
-            save_to_database(df, f"{source}_data", is_api=True)
-            st.success(f"Dati da {source} salvati correttamente")
-        except Exception as e:
-            st.error(f"Errore nel salvare i dati da {source}: {str(e)}")
-    except Exception as e:
-        st.error(f"Errore nel recupero dei dati da {source}: {str(e)}")
+            if conn.unread_result:
+                conn.consume_results()
+            cursor.close()
+        except mysql.connector.Error:
+            pass
+        finally:
+            conn.close()
 
-def opp_retrieving(pool, update_type, start_date, end_date):
-    conn = pool.get_connection()
-    cursor = conn.cursor()
+    return inserted, updated
+
+def crm_frame(rows, columns, transform, table_name):
+    with timed(table_name, 'parse'):
+        df_raw = pd.DataFrame(rows, columns=columns)
+
+    with timed(table_name, 'transform'):
+        df_raw = transform(df_raw)
+
+    record_metrics(table_name, rows_read=len(df_raw))
+
+    return df_raw
+
+def opp_transform(df_raw):
+    df_raw['createdAt'] = pd.to_datetime(df_raw['createdAt']).dt.date
+    df_raw['lastStageChangeAt'] = pd.to_datetime(df_raw['lastStageChangeAt']).dt.date
+
+    return df_raw
 
+def opp_query(condition):
     env = environ.Env()
     environ.Env.read_env()
-    
-    query = f"""
+
+    return f"""
                 SELECT
                     o.id AS id,
                     o.createdAt,
@@ -55,108 +315,98 @@ def opp_retrieving(pool, update_type, start_date, end_date):
                 WHERE
                     o.locationId='{env('id_cliente')}'
                     AND ops.pipelineId='{env('pipeline_vendita')}'
-                    AND o.{update_type} >= '{start_date}T00:00:00.000Z'
-                    AND o.{update_type} <= '{end_date}T23:59:59.999Z';
+                    AND {condition};
             """
-    
-    cursor.execute(query)
 
-    df_raw = cursor.fetchall()
+def date_condition(column, start_date, end_date):
+    return f"{column} >= '{start_date}T00:00:00.000Z' AND {column} <= '{end_date}T23:59:59.999Z'"
 
-    cursor.close()
-    conn.close()
+def opp_retrieving(pool, update_type, start_date, end_date):
+    # Le opportunità cambiano dopo la creazione (stage, vendite, valori): nessuna finestra già
+    # sincronizzata, il periodo selezionato viene riletto per intero. Le sole modifiche: changes_retrieving
+    query = opp_query(date_condition(f"o.{update_type}", start_date, end_date))
+
+    return crm_retrieve_data(pool, query, "opp_data", opp_transform,
+                             {'date_field': update_type, 'start_date': start_date, 'end_date': end_date})
 
-    df_raw = pd.DataFrame(df_raw, columns=cursor.column_names)
+def attribution_transform(df_raw):
+    df_raw['fonte'] = df_raw['fonte'].fillna('Non specificato')
     df_raw['createdAt'] = pd.to_datetime(df_raw['createdAt']).dt.date
     df_raw['lastStageChangeAt'] = pd.to_datetime(df_raw['lastStageChangeAt']).dt.date
+    df_raw['lastStageChangeAt'] = df_raw['lastStageChangeAt'].fillna(df_raw['createdAt'])
+    df_raw['data_acquisizione'] = pd.to_datetime(pd.to_numeric(df_raw['data_acquisizione'], errors='coerce'), unit='ms', errors='coerce')
+    df_raw['data_acquisizione'] = df_raw['data_acquisizione'].dt.strftime('%Y-%m-%d').fillna('N/A')
+    df_raw['data_acquisizione'] = df_raw['data_acquisizione'].replace('NaT', 'N/A')
+    df_raw['data_aggiornamento_UTM'] = pd.to_datetime(pd.to_numeric(df_raw['data_aggiornamento_UTM'], errors='coerce'), unit='ms', errors='coerce')
+    df_raw['data_aggiornamento_UTM'] = df_raw['data_aggiornamento_UTM'].dt.strftime('%Y-%m-%d').fillna('N/A')
+    df_raw['data_aggiornamento_UTM'] = df_raw['data_aggiornamento_UTM'].replace('NaT', 'N/A')
 
-    try:
-        save_to_database(df_raw, "opp_data", is_api=False)
-        st.success(f"Dati da opportunità salvati correttamente")
-    except Exception as e:
-        st.error(f"Errore nel salvare i dati da opportunità: {str(e)}")
+    return df_raw
 
-def attribution_retrieving(pool, update_type, start_date, end_date):
-    conn = pool.get_connection()
-    cursor = conn.cursor()
+def attribution_condition(update_type, start_date, end_date):
+    if update_type != "data_acquisizione":
+        return date_condition(f"o.{update_type}", start_date, end_date)
+
+    # La data è un timestamp in millisecondi salvato come testo: il confronto tra stringhe
+    # di 13 cifre usa l'indice (id, value) senza convertire ogni riga
+    day_start = int(pd.Timestamp(start_date, tz='UTC').timestamp() * 1000)
+    day_end = int((pd.Timestamp(end_date, tz='UTC') + pd.Timedelta(days=1)).timestamp() * 1000)
 
+    return f"""c.id IN (
+                        SELECT contactId FROM contact_custom_fields
+                        WHERE id = '{CUSTOM_FIELDS['data_acquisizione']}'
+                            AND value >= '{day_start}' AND value < '{day_end}'
+                    )"""
+
+def attribution_query(condition):
     env = environ.Env()
     environ.Env.read_env()
-    
-    if update_type == "data_acquisizione":
-        filter_update = f"FROM_UNIXTIME(ccf_data.value / 1000, '%Y-%m-%d')"
-    elif update_type == "createdAt":
-        filter_update = f"DATE(o.createdAt)"
-    else:
-        filter_update = f"DATE(o.lastStageChangeAt)"
-    
-    query = f"""
+
+    # Un solo passaggio su contact_custom_fields: i campi vengono riportati in colonna
+    # con un'aggregazione condizionale invece di nove join separati
+    custom_fields = ",\n".join(
+        f"                    MAX(CASE WHEN ccf.id = '{field_id}' THEN ccf.value END) AS {column}"
+        for column, field_id in CUSTOM_FIELDS.items()
+    )
+
+    return f"""
                 SELECT
                     o.id AS id,
                     o.createdAt AS createdAt,
                     o.lastStageChangeAt AS lastStageChangeAt,
-                    ccf_data.value AS data_acquisizione,
-                    COALESCE(ccf_fonte.value, 'Non specificato') AS fonte,
                     ops.name AS pipeline_stage_name,
                     o.monetaryValue AS opportunity_monetary_value,
-                    ccf_dataAggiornamentoUtm.value AS data_aggiornamento_UTM,
-                    ccf_campaignId.value AS campaign_id,
-                    ccf_campaignSource.value AS campaign_source,
-                    ccf_campaignMedium.value AS campaign_medium,
-                    ccf_campaignName.value AS campaign_name,
-                    ccf_campaignTerm.value AS campaign_term,
-                    ccf_campaignContent.value AS campaign_content
+{custom_fields}
                 FROM
                     opportunities o
                     INNER JOIN opportunity_pipeline_stages ops ON o.pipelineStageId = ops.id
                     LEFT JOIN contacts c ON o.contactId = c.id
-                    LEFT JOIN contact_custom_fields ccf_data ON c.id = ccf_data.contactId AND ccf_data.id = 'ok7yK4uSS6wh0S2DnZrz'
-                    LEFT JOIN contact_custom_fields ccf_fonte ON c.id = ccf_fonte.contactId AND ccf_fonte.id = 'UiALy82OthZAitbSZTOU'
-                    LEFT JOIN contact_custom_fields ccf_dataAggiornamentoUtm ON c.id = ccf_dataAggiornamentoUtm.contactId AND ccf_dataAggiornamentoUtm.id = 'U6YOWEUW5qpa7GEwj0MQ'
-                    LEFT JOIN contact_custom_fields ccf_campaignId ON c.id = ccf_campaignId.contactId AND ccf_campaignId.id = 'KAeN2BZw4yg3HrZJ953G'
-                    LEFT JOIN contact_custom_fields ccf_campaignSource ON c.id = ccf_campaignSource.contactId AND ccf_campaignSource.id = 'bv2mwtwOf8lOJk0AGyCC'
-                    LEFT JOIN contact_custom_fields ccf_campaignMedium ON c.id = ccf_campaignMedium.contactId AND ccf_campaignMedium.id = 'PsuKaybjKzA5YirzWN5P'
-                    LEFT JOIN contact_custom_fields ccf_campaignName ON c.id = ccf_campaignName.contactId AND ccf_campaignName.id = 'cgo2pmNOEliZzooENxwM'
-                    LEFT JOIN contact_custom_fields ccf_campaignTerm ON c.id = ccf_campaignTerm.contactId AND ccf_campaignTerm.id = 'LfJ9fcY6Fney8A7MiEwH'
-                    LEFT JOIN contact_custom_fields ccf_campaignContent ON c.id = ccf_campaignContent.contactId AND ccf_campaignContent.id = '0r8SuUE9KTknXxnknYtl'
+                    LEFT JOIN contact_custom_fields ccf ON c.id = ccf.contactId
+                        AND ccf.id IN ({', '.join(f"'{field_id}'" for field_id in CUSTOM_FIELDS.values())})
                 WHERE
                     o.locationId = '{env('id_cliente')}'
                     AND ops.pipelineId = '{env('pipeline_vendita')}'
-                    AND {filter_update} BETWEEN '{start_date}' AND '{end_date}';
+                    AND {condition}
+                GROUP BY
+                    o.id, o.createdAt, o.lastStageChangeAt, ops.name, o.monetaryValue;
             """
-    
-    cursor.execute(query)
 
-    df_raw = cursor.fetchall()
-    
-    cursor.close()
-    conn.close()
+def attribution_retrieving(pool, update_type, start_date, end_date):
+    query = attribution_query(attribution_condition(update_type, start_date, end_date))
 
-    df_raw = pd.DataFrame(df_raw, columns=cursor.column_names)
-    df_raw['createdAt'] = pd.to_datetime(df_raw['createdAt']).dt.date
-    df_raw['lastStageChangeAt'] = pd.to_datetime(df_raw['lastStageChangeAt']).dt.date
-    df_raw['lastStageChangeAt'] = df_raw['lastStageChangeAt'].fillna(df_raw['createdAt'])
-    df_raw['data_acquisizione'] = pd.to_datetime(pd.to_numeric(df_raw['data_acquisizione'], errors='coerce'), unit='ms', errors='coerce')
-    df_raw['data_acquisizione'] = df_raw['data_acquisizione'].dt.strftime('%Y-%m-%d').fillna('N/A')
-    df_raw['data_acquisizione'] = df_raw['data_acquisizione'].replace('NaT', 'N/A')
-    df_raw['data_aggiornamento_UTM'] = pd.to_datetime(pd.to_numeric(df_raw['data_aggiornamento_UTM'], errors='coerce'), unit='ms', errors='coerce')
-    df_raw['data_aggiornamento_UTM'] = df_raw['data_aggiornamento_UTM'].dt.strftime('%Y-%m-%d').fillna('N/A')
-    df_raw['data_aggiornamento_UTM'] = df_raw['data_aggiornamento_UTM'].replace('NaT', 'N/A')
+    return crm_retrieve_data(pool, query, "attribution_data", attribution_transform,
+                             {'date_field': update_type, 'start_date': start_date, 'end_date': end_date})
 
-    try:
-        save_to_database(df_raw, "attribution_data", is_api=False)
-        st.success(f"Dati da attribuzione salvati correttamente")
-    except Exception as e:
-        st.error(f"Errore nel salvare i dati da attribuzione: {str(e)}")
+def transaction_transform(df_raw):
+    df_raw['date'] = pd.to_datetime(df_raw['date']).dt.date
 
-def transaction_retrieving(pool, start_date, end_date):
-    conn = pool.get_connection()
-    cursor = conn.cursor()
+    return df_raw
 
+def transaction_query(condition):
     env = environ.Env()
     environ.Env.read_env()
-    
-    query = f"""
+
+    return f"""
                 SELECT
                     pay.contactId AS id,
                     pay.createdAt AS date,
@@ -169,21 +419,83 @@ def transaction_retrieving(pool, start_date, end_date):
                     payment_transactions pay
                 WHERE
                     pay.altId = '{env('id_cliente')}'
-                    AND pay.createdAt BETWEEN '{start_date}' AND '{end_date}';
+                    AND {condition};
             """
-    
-    cursor.execute(query)
 
-    df_raw = cursor.fetchall()
-    
-    cursor.close()
-    conn.close()
+def transaction_retrieving(pool, start_date, end_date):
+    # Anche lo stato dei pagamenti cambia dopo la creazione: il periodo viene riletto per intero
+    query = transaction_query(f"pay.createdAt BETWEEN '{start_date}' AND '{end_date}'")
 
-    df_raw = pd.DataFrame(df_raw, columns=cursor.column_names)
-    df_raw['date'] = pd.to_datetime(df_raw['date']).dt.date
+    return crm_retrieve_data(pool, query, "transaction_data", transaction_transform,
+                             {'date_field': 'date', 'start_date': start_date, 'end_date': end_date})
+
+def changes_retrieving(pool, table_name, full_refresh=False):
+    # Sincronizzazione per modifiche: solo le righe cambiate dall'ultimo high-water mark,
+    # qualunque sia la loro data. Senza high-water mark scarica tutto lo storico una volta.
+    source_table, alias, location_column, changed_column, query, transform = CHANGE_SOURCES[table_name]
+    account_id = env('id_cliente', default='')
+    state_field = f"cdc_{changed_column}"
+
+    since = None if full_refresh else get_high_water_mark(table_name, state_field, account_id)
+    until = crm_high_water_mark(pool, source_table, location_column, changed_column, account_id)
+    if until is None:
+        return None
+
+    # Il limite superiore fissato prima dell'estrazione: le modifiche successive restano per il prossimo giro.
+    # Il limite inferiore è incluso: righe con lo stesso updatedAt dell'ultima letta ma registrate dopo
+    # la lettura precedente vengono riprese, e l'upsert assorbe quelle già salvate
+    condition = f"{alias}.{changed_column} <= '{until}'"
+    if since is not None:
+        condition += f" AND {alias}.{changed_column} >= '{since}'"
+
+    result = crm_retrieve_data(pool, query(condition), table_name, transform,
+                               {'date_field': state_field, 'account_id': account_id, 'high_water_mark': until})
+    update_high_water_mark(table_name, state_field, account_id, until)
+
+    return result
+
+def crm_high_water_mark(pool, source_table, location_column, changed_column, account_id):
+    conn = pool.get_connection()
+    cursor = conn.cursor()
 
     try:
-        save_to_database(df_raw, "transaction_data", is_api=False)
-        st.success(f"Dati da transazioni salvati correttamente")
-    except Exception as e:
-        st.error(f"Errore nel salvare i dati da transazioni: {str(e)}")
+        cursor.execute(f"SELECT MAX({changed_column}) FROM {source_table} WHERE {location_column} = %s", [account_id])
+        high_water_mark = cursor.fetchone()[0]
+    finally:
+        cursor.close()
+        conn.close()
+
+    return str(high_water_mark) if high_water_mark is not None else None
+
+CHANGE_SOURCES = {
+    'opp_data': ('opportunities', 'o', 'locationId', CRM_OPP_CHANGED_COLUMN, opp_query, opp_transform),
+    'attribution_data': ('opportunities', 'o', 'locationId', CRM_OPP_CHANGED_COLUMN, attribution_query, attribution_transform),
+    'transaction_data': ('payment_transactions', 'pay', 'altId', CRM_PAYMENT_CHANGED_COLUMN, transaction_query, transaction_transform)
+}
+
+def replay_cached(table_name):
+    # Ricostruisce la tabella dalle risposte salvate in raw_cache, senza rete
+    transform = CHANGE_SOURCES[table_name][5] if table_name in CHANGE_SOURCES else None
+    inserted, updated = 0, 0
+
+    for entry in iter_cached(table_name):
+        for df, is_api in cached_batches(entry, transform):
+            batch_inserted, batch_updated = save_to_database(df, table_name, is_api=is_api)
+            inserted += batch_inserted
+            updated += batch_updated
+
+        if 'high_water_mark' in entry:
+            update_high_water_mark(table_name, entry['date_field'], entry['account_id'], entry['high_water_mark'])
+        elif entry['kind'] == 'api':
+            mark_synced(table_name, entry['date_field'], date.fromisoformat(entry['start_date']), date.fromisoformat(entry['end_date']))
+
+    return inserted, updated
+
+def cached_batches(entry, transform):
+    if entry['kind'] == 'api':
+        with gzip.open(entry['path'], 'rb') as body:
+            for df in record_batches(iter_json_records(body, source=entry['table']), source=entry['table']):
+                yield df, True
+    else:
+        for columns, rows in read_cached_rows(entry):
+            yield crm_frame(rows, columns, transform, entry['table']), False
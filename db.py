@@ -1,14 +1,194 @@
 import sqlite3
+import queue
+import json
+import threading
+from contextlib import contextmanager
+from datetime import date, datetime
 import streamlit as st
 import pandas as pd
 import environ
 
-from config import FIELDS
+from config import FIELDS, CUSTOM_FIELDS
+from metrics import timed, record as record_metrics
+
+env = environ.Env()
+environ.Env.read_env()
+
+DB_PATH = env('db_path', default='local_data.db')
+
+# Connessioni riutilizzate tra sessioni e rerun: la page cache resta calda.
+# In WAL le letture della dashboard non si bloccano durante un aggiornamento.
+PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -65536,
+    'mmap_size': 268435456,
+    'temp_store': 'MEMORY',
+    'busy_timeout': 30000
+}
+
+_connections = queue.LifoQueue()
+
+# Schema e migrazioni vengono applicati alla prima connessione del processo
+_schema_ready = False
+_schema_lock = threading.Lock()
+
+# Un solo scrittore alla volta: gli aggiornamenti paralleli si accodano qui invece
+# di contendersi il lock di SQLite
+_write_lock = threading.Lock()
+
+def _connect():
+    global _schema_ready
+
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    for pragma, value in PRAGMAS.items():
+        conn.execute(f"PRAGMA {pragma} = {value}")
+
+    # Database creati da versioni precedenti: tabelle di servizio e riepiloghi non dipendono
+    # dal pulsante di inizializzazione
+    with _schema_lock:
+        if not _schema_ready:
+            try:
+                initialize_schema(conn.cursor())
+                conn.commit()
+            except Exception:
+                conn.close()
+                raise
+            _schema_ready = True
+
+    return conn
+
+@contextmanager
+def get_connection():
+    try:
+        conn = _connections.get_nowait()
+    except queue.Empty:
+        conn = _connect()
+
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        _connections.put(conn)
+
+def get_tables():
+    with get_connection() as conn:
+        cursor = conn.execute("SELECT name FROM sqlite_master WHERE type='table';")
+        return [row[0] for row in cursor.fetchall() if row[0] not in INTERNAL_TABLES]
+
+# Tabelle di servizio (riepiloghi, sincronizzazione, metriche, versioni): non si gestiscono dalle Impostazioni
+INTERNAL_TABLES = {'daily_summary', 'opp_daily_summary', 'sync_state', 'sync_chunks', 'sync_log', 'ingest_metrics', 'http_request_stats', 'crm_pool_stats', 'data_versions'}
+
+KEY_COLUMNS = {
+    'facebook_data': ['date', 'campaign', 'adset_name', 'ad_name', 'age', 'gender'],
+    'google_ads_data': ['date', 'campaign'],
+    'tiktok_data': ['date', 'campaign', 'ad_group_name', 'ad_name'],
+    'googleanalytics4_data': ['date', 'campaign'],
+    'opp_data': ['id'],
+    'attribution_data': ['id'],
+    'transaction_data': ['id']
+}
+
+# Le chiavi delle tabelle API iniziano con la data: basta un indice su account_id + data
+INDEXES = {
+    'facebook_data': [['account_id', 'date']],
+    'facebook_geo_data': [['account_id', 'date']],
+    'google_ads_data': [['account_id', 'date']],
+    'tiktok_data': [['account_id', 'date']],
+    'googleanalytics4_data': [['account_id', 'date']],
+    'opp_data': [['createdAt'], ['lastStageChangeAt']],
+    'attribution_data': [['createdAt'], ['lastStageChangeAt'], ['data_acquisizione']],
+    'transaction_data': [['date']],
+    'opp_daily_summary': [['date_field', 'date']]
+}
+
+# Riepiloghi giornalieri per fonte, account e campagna, ricalcolati in save_to_database
+# per i soli giorni toccati dall'aggiornamento
+SUMMARY_METRICS = {
+    'facebook_data': {
+        'spend': 'SUM(spend)',
+        'impressions': 'SUM(impressions)',
+        'clicks': 'SUM(outbound_clicks_outbound_click)',
+        'leads': 'SUM(actions_lead)',
+        'purchases': 'SUM(actions_purchase)'
+    },
+    'google_ads_data': {
+        'spend': 'SUM(spend)',
+        'impressions': 'SUM(impressions)',
+        'clicks': 'SUM(clicks)'
+    },
+    'tiktok_data': {
+        'spend': 'SUM(spend)',
+        'impressions': 'SUM(impressions)',
+        'clicks': 'SUM(clicks)',
+        'leads': 'SUM(total_sales_lead)',
+        'purchases': 'SUM(total_purchase)'
+    },
+    'googleanalytics4_data': {
+        'sessions': 'SUM(sessions)',
+        'engaged_sessions': 'SUM(engaged_sessions)',
+        'active_users': 'SUM(active_users)',
+        'user_engagement_duration': 'SUM(user_engagement_duration)'
+    }
+}
+
+OPP_DATE_FIELDS = ['createdAt', 'lastStageChangeAt']
+
+# Tipi applicati in lettura da get_data: date come datetime64, stringhe ripetitive
+# come categorie e contatori ridotti al tipo intero più piccolo
+DTYPES = {
+    'facebook_data': {
+        'date': 'date',
+        **dict.fromkeys(['account_id', 'campaign', 'adset_name', 'adset_status', 'ad_name', 'status', 'link', 'age', 'gender'], 'category'),
+        **dict.fromkeys(['impressions', 'outbound_clicks_outbound_click', 'actions_lead', 'actions_purchase'], 'count')
+    },
+    'google_ads_data': {
+        'date': 'date',
+        **dict.fromkeys(['account_id', 'campaign', 'keyword_text'], 'category'),
+        **dict.fromkeys(['impressions', 'clicks'], 'count')
+    },
+    'tiktok_data': {
+        'date': 'date',
+        **dict.fromkeys(['account_id', 'campaign', 'ad_group_name', 'ad_group_operation_status', 'ad_name', 'ad_operation_status'], 'category'),
+        **dict.fromkeys(['impressions', 'clicks', 'total_sales_lead', 'total_purchase'], 'count')
+    },
+    'googleanalytics4_data': {
+        'date': 'date',
+        **dict.fromkeys(['account_id', 'source', 'campaign', 'page_path'], 'category'),
+        **dict.fromkeys(['sessions', 'engaged_sessions', 'active_users'], 'count')
+    },
+    'opp_data': {
+        **dict.fromkeys(['createdAt', 'lastStageChangeAt'], 'date'),
+        **dict.fromkeys(['venditore', 'stage'], 'category')
+    },
+    'attribution_data': {
+        **dict.fromkeys(['createdAt', 'lastStageChangeAt', 'data_acquisizione'], 'date'),
+        **dict.fromkeys(['fonte', 'pipeline_stage_name'], 'category')
+    },
+    'transaction_data': {
+        'date': 'date',
+        **dict.fromkeys(['product_name', 'currency', 'status'], 'category')
+    },
+    'daily_summary': {
+        'date': 'date',
+        **dict.fromkeys(['source', 'account_id', 'campaign'], 'category'),
+        **dict.fromkeys(['impressions', 'clicks', 'leads', 'purchases', 'sessions', 'engaged_sessions', 'active_users'], 'count')
+    },
+    'opp_daily_summary': {
+        'date': 'date',
+        **dict.fromkeys(['date_field', 'stage', 'venditore'], 'category'),
+        'opportunities': 'count'
+    }
+}
 
 def initialize_database():
-    conn = sqlite3.connect('local_data.db')
-    c = conn.cursor()
-    
+    with get_connection() as conn:
+        initialize_schema(conn.cursor())
+
+def initialize_schema(c):
     c.execute('''CREATE TABLE IF NOT EXISTS facebook_data
                 (datasource TEXT, 
                 source TEXT, 
@@ -102,6 +282,13 @@ def initialize_database():
                 lastStageChangeAt TEXT, 
                 data_acquisizione TEXT, 
                 fonte TEXT, 
+                data_aggiornamento_UTM TEXT, 
+                campaign_id TEXT, 
+                campaign_source TEXT, 
+                campaign_medium TEXT, 
+                campaign_name TEXT, 
+                campaign_term TEXT, 
+                campaign_content TEXT, 
                 pipeline_stage_name TEXT, 
                 opportunity_monetary_value REAL)''')
 
@@ -114,141 +301,623 @@ def initialize_database():
                 currency TEXT, 
                 status TEXT)''')
 
-    conn.commit()
-    conn.close()
+    c.execute('''CREATE TABLE IF NOT EXISTS daily_summary
+                (source TEXT, 
+                account_id TEXT, 
+                campaign TEXT, 
+                date TEXT, 
+                spend REAL, 
+                impressions INTEGER, 
+                clicks INTEGER, 
+                leads INTEGER, 
+                purchases INTEGER, 
+                sessions INTEGER, 
+                engaged_sessions INTEGER, 
+                active_users INTEGER, 
+                user_engagement_duration REAL, 
+                PRIMARY KEY (source, account_id, campaign, date))''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS opp_daily_summary
+                (date_field TEXT, 
+                date TEXT, 
+                stage TEXT, 
+                venditore TEXT, 
+                opportunities INTEGER, 
+                monetaryValue REAL)''')
+
+    create_sync_state(c)
+    create_sync_log(c)
+    create_ingest_metrics(c)
+    create_request_stats(c)
+    create_pool_stats(c)
+    create_data_versions(c)
+
+    migrate_database(c)
+
+def migrate_database(cursor):
+    # Idempotente: sui database esistenti deduplica e aggiunge chiavi e indici mancanti
+    changes = cursor.connection.total_changes
+
+    for table_name, key_columns in KEY_COLUMNS.items():
+        ensure_unique_key(cursor, table_name, key_columns)
+
+    # Campi personalizzati del CRM aggiunti dopo la creazione della tabella
+    cursor.execute("PRAGMA table_info(attribution_data)")
+    existing = {row[1] for row in cursor.fetchall()}
+    for column in CUSTOM_FIELDS:
+        if column not in existing:
+            cursor.execute(f"ALTER TABLE attribution_data ADD COLUMN {column} TEXT")
+
+    for table_name, columns in INDEXES.items():
+        for index_columns in columns:
+            index_name = f"{table_name}_{'_'.join(index_columns)}"
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {table_name} ({', '.join(index_columns)})")
+
+    # Database esistenti: i riepiloghi appena creati vengono popolati con tutto lo storico
+    cursor.execute("SELECT COUNT(*) FROM daily_summary")
+    if cursor.fetchone()[0] == 0:
+        for table_name in SUMMARY_METRICS:
+            refresh_daily_summary(cursor, table_name)
+
+    cursor.execute("SELECT COUNT(*) FROM opp_daily_summary")
+    if cursor.fetchone()[0] == 0:
+        refresh_daily_summary(cursor, 'opp_data')
+
+    # Righe deduplicate o riepiloghi ricostruiti: i risultati degli analyzer in cache non valgono più
+    if cursor.connection.total_changes > changes:
+        for table_name in KEY_COLUMNS:
+            bump_data_version(cursor, table_name)
 
 def add_column(table_name, column_name, column_type):
-    conn = sqlite3.connect('local_data.db')
-    cursor = conn.cursor()
-    
-    try:
-        cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type}")
-        st.success(f"Colonna {column_name} aggiunta correttamente")
-    except sqlite3.OperationalError as e:
-        st.error(f"Errore durante l'aggiunta della colonna {column_name}: {e}")
+    with get_connection() as conn:
+        cursor = conn.cursor()
 
-    conn.commit()
-    conn.close()
+        try:
+            cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type}")
+            bump_data_version(cursor, table_name)
+            st.success(f"Colonna {column_name} aggiunta correttamente")
+        except sqlite3.OperationalError as e:
+            st.error(f"Errore durante l'aggiunta della colonna {column_name}: {e}")
 
 def delete_column(table_name, column_name):
-    conn = sqlite3.connect('local_data.db')
-    cursor = conn.cursor()
-    
-    try:
-        cursor.execute(f"ALTER TABLE {table_name} DROP COLUMN {column_name}")
-        st.success(f"Colonna {column_name} eliminata correttamente")
-    except sqlite3.OperationalError as e:
-        st.error(f"Errore durante l'eliminazione della colonna {column_name}: {e}")
+    with get_connection() as conn:
+        cursor = conn.cursor()
 
-    conn.commit()
-    conn.close()
+        try:
+            cursor.execute(f"ALTER TABLE {table_name} DROP COLUMN {column_name}")
+            bump_data_version(cursor, table_name)
+            st.success(f"Colonna {column_name} eliminata correttamente")
+        except sqlite3.OperationalError as e:
+            st.error(f"Errore durante l'eliminazione della colonna {column_name}: {e}")
 
 def delete_table(table_name):
-    conn = sqlite3.connect('local_data.db')
-    cursor = conn.cursor()
+    with get_connection() as conn:
+        cursor = conn.cursor()
 
-    try:
-        cursor.execute(f"DROP TABLE IF EXISTS {table_name}")
-        st.success(f"Tabella {table_name} eliminata correttamente")
-    except sqlite3.OperationalError as e:
-        st.error(f"Errore durante l'eliminazione della tabella {table_name}: {e}")
-    
-    conn.commit()
-    conn.close()
+        try:
+            cursor.execute(f"DROP TABLE IF EXISTS {table_name}")
+            clear_daily_summary(cursor, table_name)
+            clear_sync_state(cursor, table_name)
+            bump_data_version(cursor, table_name)
+            st.success(f"Tabella {table_name} eliminata correttamente")
+        except sqlite3.OperationalError as e:
+            st.error(f"Errore durante l'eliminazione della tabella {table_name}: {e}")
 
 def delete_table_data(table_name):
-    conn = sqlite3.connect('local_data.db')
-    cursor = conn.cursor()
-    
-    try:
-        cursor.execute(f"DELETE FROM {table_name}")
-        st.success(f"Dati della tabella {table_name} eliminati correttamente")
-    except sqlite3.OperationalError as e:
-        st.error(f"Errore durante l'eliminazione dei dati della tabella {table_name}: {e}")
+    with get_connection() as conn:
+        cursor = conn.cursor()
+
+        try:
+            cursor.execute(f"DELETE FROM {table_name}")
+            clear_daily_summary(cursor, table_name)
+            clear_sync_state(cursor, table_name)
+            bump_data_version(cursor, table_name)
+            st.success(f"Dati della tabella {table_name} eliminati correttamente")
+        except sqlite3.OperationalError as e:
+            st.error(f"Errore durante l'eliminazione dei dati della tabella {table_name}: {e}")
+
+def get_key_columns(table_name, is_api=True):
+    if not is_api:
+        return ['id']
+
+    if table_name not in KEY_COLUMNS:
+        st.warning(f"Tabella {table_name} non supportata nella funzione save_to_database. I dati potrebbero non essere salvati correttamente.")
+
+    return KEY_COLUMNS.get(table_name, ['date', 'campaign'])
+
+def ensure_unique_key(cursor, table_name, key_columns):
+    # L'upsert ON CONFLICT richiede un indice univoco sulle colonne chiave:
+    # se manca, rimuoviamo i duplicati storici e lo creiamo.
+    index_name = f"{table_name}_key"
+    cursor.execute(f"PRAGMA index_list({table_name})")
+    if index_name in [row[1] for row in cursor.fetchall()]:
+        return
+
+    for col in key_columns:
+        cursor.execute(f"UPDATE {table_name} SET {col} = '' WHERE {col} IS NULL")
+
+    cursor.execute(f"""DELETE FROM {table_name} WHERE rowid NOT IN
+                    (SELECT MAX(rowid) FROM {table_name} GROUP BY {', '.join(key_columns)})""")
+    cursor.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {index_name} ON {table_name} ({', '.join(key_columns)})")
+
+def count_existing_keys(cursor, table_name, key_columns, df):
+    # Chiavi del blocco già presenti, cercate sull'indice univoco: il costo dipende dal blocco
+    # e non dalla dimensione della tabella
+    cursor.execute("DROP TABLE IF EXISTS temp.batch_keys")
+    cursor.execute(f"CREATE TEMP TABLE batch_keys ({', '.join(key_columns)})")
+    cursor.executemany(f"INSERT INTO temp.batch_keys VALUES ({', '.join(['?' for _ in key_columns])})",
+                       df[key_columns].itertuples(index=False, name=None))
+
+    match = " AND ".join(f"t.{col} = b.{col}" for col in key_columns)
+    cursor.execute(f"SELECT COUNT(*) FROM temp.batch_keys b WHERE EXISTS (SELECT 1 FROM {table_name} t WHERE {match})")
+    existing = cursor.fetchone()[0]
+    cursor.execute("DROP TABLE temp.batch_keys")
+
+    return existing
+
+def get_touched_days(cursor, table_name, df):
+    if table_name in SUMMARY_METRICS:
+        return {'date': df['date'].astype(str).unique().tolist()}
+
+    if table_name != 'opp_data':
+        return {}
+
+    # Un cambio stage sposta l'opportunità di giorno: vanno ricalcolati anche i giorni precedenti
+    cursor.execute(f"SELECT {', '.join(OPP_DATE_FIELDS)} FROM opp_data WHERE id IN (SELECT value FROM json_each(?))",
+                   [json.dumps(df['id'].astype(str).tolist())])
+    previous = pd.DataFrame(cursor.fetchall(), columns=OPP_DATE_FIELDS)
+
+    return {
+        date_field: pd.concat([df[date_field], previous[date_field]]).dropna().astype(str).unique().tolist()
+        for date_field in OPP_DATE_FIELDS
+    }
+
+def refresh_daily_summary(cursor, table_name, touched_days=None):
+    # touched_days None ricostruisce l'intero storico della tabella
+    def day_filter(column, date_field):
+        if touched_days is None:
+            return "1 = 1", []
+        return f"{column} IN (SELECT value FROM json_each(?))", [json.dumps(touched_days.get(date_field, []))]
+
+    if table_name in SUMMARY_METRICS:
+        source = table_name.removesuffix("_data")
+        metrics = SUMMARY_METRICS[table_name]
+        where, params = day_filter('date', 'date')
+
+        cursor.execute(f"DELETE FROM daily_summary WHERE source = ? AND {where}", [source] + params)
+        cursor.execute(f"""INSERT INTO daily_summary (source, account_id, campaign, date, {', '.join(metrics)})
+                        SELECT ?, account_id, campaign, date, {', '.join(metrics.values())}
+                        FROM {table_name} WHERE {where}
+                        GROUP BY account_id, campaign, date""", [source] + params)
+    elif table_name == 'opp_data':
+        for date_field in OPP_DATE_FIELDS:
+            summary_where, summary_params = day_filter('date', date_field)
+            where, params = day_filter(date_field, date_field)
+
+            cursor.execute(f"DELETE FROM opp_daily_summary WHERE date_field = ? AND {summary_where}", [date_field] + summary_params)
+            cursor.execute(f"""INSERT INTO opp_daily_summary (date_field, date, stage, venditore, opportunities, monetaryValue)
+                            SELECT ?, {date_field}, stage, venditore, COUNT(*), SUM(monetaryValue)
+                            FROM opp_data WHERE {date_field} IS NOT NULL AND {where}
+                            GROUP BY {date_field}, stage, venditore""", [date_field] + params)
+
+def clear_daily_summary(cursor, table_name):
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name IN ('daily_summary', 'opp_daily_summary')")
+    summary_tables = [row[0] for row in cursor.fetchall()]
+
+    if table_name in SUMMARY_METRICS and 'daily_summary' in summary_tables:
+        cursor.execute("DELETE FROM daily_summary WHERE source = ?", [table_name.removesuffix("_data")])
+    elif table_name == 'opp_data' and 'opp_daily_summary' in summary_tables:
+        cursor.execute("DELETE FROM opp_daily_summary")
+
+def create_sync_state(cursor):
+    cursor.execute('''CREATE TABLE IF NOT EXISTS sync_state
+                    (source TEXT, 
+                    date_field TEXT, 
+                    account_id TEXT, 
+                    synced_from TEXT, 
+                    synced_to TEXT, 
+                    updated_at TEXT, 
+                    PRIMARY KEY (source, date_field, account_id))''')
+
+    # Blocchi di date già scaricati di un aggiornamento non ancora concluso
+    cursor.execute('''CREATE TABLE IF NOT EXISTS sync_chunks
+                    (source TEXT, 
+                    account_id TEXT, 
+                    chunk_start TEXT, 
+                    chunk_end TEXT, 
+                    completed_at TEXT, 
+                    PRIMARY KEY (source, account_id, chunk_start, chunk_end))''')
+
+def get_sync_state(source, date_field, account_id):
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        create_sync_state(cursor)
+        cursor.execute("SELECT synced_from, synced_to FROM sync_state WHERE source = ? AND date_field = ? AND account_id = ?",
+                       [source, date_field, account_id])
+        row = cursor.fetchone()
+
+    return tuple(date.fromisoformat(day) for day in row) if row else None
+
+def update_sync_state(source, date_field, account_id, synced_from, synced_to):
+    with _write_lock, get_connection() as conn:
+        cursor = conn.cursor()
+        create_sync_state(cursor)
+        cursor.execute("""INSERT INTO sync_state (source, date_field, account_id, synced_from, synced_to, updated_at)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                        ON CONFLICT (source, date_field, account_id) DO UPDATE SET
+                        synced_from = excluded.synced_from, synced_to = excluded.synced_to, updated_at = excluded.updated_at""",
+                       [source, date_field, account_id, str(synced_from), str(synced_to), datetime.now().isoformat(timespec='seconds')])
+
+def get_high_water_mark(source, date_field, account_id):
+    # Per la sincronizzazione per modifiche synced_to conserva il valore grezzo della colonna di modifica
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        create_sync_state(cursor)
+        cursor.execute("SELECT synced_to FROM sync_state WHERE source = ? AND date_field = ? AND account_id = ?",
+                       [source, date_field, account_id])
+        row = cursor.fetchone()
+
+    return row[0] if row else None
 
-    conn.commit()
-    conn.close()
+def update_high_water_mark(source, date_field, account_id, high_water_mark):
+    with _write_lock, get_connection() as conn:
+        cursor = conn.cursor()
+        create_sync_state(cursor)
+        cursor.execute("""INSERT INTO sync_state (source, date_field, account_id, synced_to, updated_at)
+                        VALUES (?, ?, ?, ?, ?)
+                        ON CONFLICT (source, date_field, account_id) DO UPDATE SET
+                        synced_to = excluded.synced_to, updated_at = excluded.updated_at""",
+                       [source, date_field, account_id, high_water_mark, datetime.now().isoformat(timespec='seconds')])
+
+def create_sync_log(cursor):
+    cursor.execute('''CREATE TABLE IF NOT EXISTS sync_log
+                    (run_id TEXT, 
+                    trigger TEXT, 
+                    source TEXT, 
+                    started_at TEXT, 
+                    finished_at TEXT, 
+                    status TEXT, 
+                    inserted INTEGER, 
+                    updated INTEGER, 
+                    error TEXT)''')
+
+def log_sync(run_id, trigger, source, started_at, status, inserted=None, updated=None, error=None):
+    # Una riga per fonte e aggiornamento: lo stato 'in corso' viene sostituito dall'esito finale
+    finished_at = None if status == 'in corso' else datetime.now().isoformat(timespec='seconds')
+
+    with _write_lock, get_connection() as conn:
+        cursor = conn.cursor()
+        create_sync_log(cursor)
+        cursor.execute("DELETE FROM sync_log WHERE run_id = ? AND source = ?", [run_id, source])
+        cursor.execute("INSERT INTO sync_log VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                       [run_id, trigger, source, started_at, finished_at, status, inserted, updated, error])
+
+def get_sync_log(limit=50):
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        create_sync_log(cursor)
+
+        return pd.read_sql_query("SELECT * FROM sync_log ORDER BY finished_at IS NOT NULL, finished_at DESC LIMIT ?", conn, params=[limit])
+
+def get_sync_progress():
+    # Stato di ogni fonte dell'ultimo aggiornamento, con i blocchi di date già salvati da quelle ancora in corso
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        create_sync_state(cursor)
+        create_sync_log(cursor)
+
+        return pd.read_sql_query("""SELECT l.source, l.status, l.inserted, l.updated, l.error,
+                                 (SELECT COUNT(*) FROM sync_chunks c WHERE c.source = l.source) AS blocchi_completati
+                                 FROM sync_log l
+                                 WHERE l.run_id = (SELECT run_id FROM sync_log ORDER BY started_at DESC LIMIT 1)
+                                 ORDER BY l.source""", conn)
+
+# Tempi per fase di ogni fonte: rete, parsing, trasformazione e scrittura su SQLite
+METRIC_COLUMNS = ['rows_read', 'rows_written', 'bytes', 'network_s', 'parse_s', 'transform_s', 'write_s', 'total_s', 'errors']
+
+def create_ingest_metrics(cursor):
+    cursor.execute(f'''CREATE TABLE IF NOT EXISTS ingest_metrics
+                    (run_id TEXT, 
+                    source TEXT, 
+                    {', '.join(f"{column} REAL" for column in METRIC_COLUMNS)}, 
+                    PRIMARY KEY (run_id, source))''')
+
+def log_metrics(run_id, source, metrics):
+    with _write_lock, get_connection() as conn:
+        cursor = conn.cursor()
+        create_ingest_metrics(cursor)
+        cursor.execute(f"INSERT OR REPLACE INTO ingest_metrics (run_id, source, {', '.join(METRIC_COLUMNS)}) VALUES ({', '.join(['?'] * (len(METRIC_COLUMNS) + 2))})",
+                       [run_id, source] + [metrics.get(column, 0) for column in METRIC_COLUMNS])
+
+def get_ingest_history(limit=200):
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        create_sync_log(cursor)
+        create_ingest_metrics(cursor)
+
+        return pd.read_sql_query(f"""SELECT l.finished_at, l.trigger, l.source, l.status, {', '.join(f"m.{column}" for column in METRIC_COLUMNS)}
+                                 FROM sync_log l JOIN ingest_metrics m ON m.run_id = l.run_id AND m.source = l.source
+                                 ORDER BY l.finished_at DESC LIMIT ?""", conn, params=[limit])
+
+# Richieste HTTP di ogni fonte API: numero, errori, byte e latenze
+REQUEST_COLUMNS = ['richieste', 'errori', 'byte_ricevuti', 'compresse', 'primo_byte_medio_s', 'primo_byte_max_s', 'totale_medio_s', 'totale_max_s']
+
+def create_request_stats(cursor):
+    cursor.execute(f'''CREATE TABLE IF NOT EXISTS http_request_stats
+                    (run_id TEXT, 
+                    source TEXT, 
+                    {', '.join(f"{column} REAL" for column in REQUEST_COLUMNS)}, 
+                    PRIMARY KEY (run_id, source))''')
+
+def log_request_stats(run_id, source, stats):
+    with _write_lock, get_connection() as conn:
+        cursor = conn.cursor()
+        create_request_stats(cursor)
+        cursor.execute(f"INSERT OR REPLACE INTO http_request_stats (run_id, source, {', '.join(REQUEST_COLUMNS)}) VALUES ({', '.join(['?'] * (len(REQUEST_COLUMNS) + 2))})",
+                       [run_id, source] + [stats.get(column) for column in REQUEST_COLUMNS])
+
+def get_request_history(limit=200):
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        create_sync_log(cursor)
+        create_request_stats(cursor)
+
+        return pd.read_sql_query(f"""SELECT l.run_id, l.finished_at, l.source, {', '.join(f"r.{column}" for column in REQUEST_COLUMNS)}
+                                 FROM sync_log l JOIN http_request_stats r ON r.run_id = l.run_id AND r.source = l.source
+                                 ORDER BY l.finished_at DESC LIMIT ?""", conn, params=[limit])
+
+# Contatori del pool di connessioni al CRM del processo di ingest.py, salvati a fine aggiornamento
+POOL_COLUMNS = ['acquisizioni', 'connessioni_create', 'connessioni_riusate', 'scadute', 'ping_falliti', 'risultati_pendenti',
+                'attesa_totale_s', 'attesa_massima_s', 'inattive', 'dimensione']
+
+def create_pool_stats(cursor):
+    cursor.execute(f'''CREATE TABLE IF NOT EXISTS crm_pool_stats
+                    (run_id TEXT PRIMARY KEY, 
+                    recorded_at TEXT, 
+                    {', '.join(f"{column} REAL" for column in POOL_COLUMNS)})''')
+
+def log_pool_stats(run_id, stats):
+    with _write_lock, get_connection() as conn:
+        cursor = conn.cursor()
+        create_pool_stats(cursor)
+        cursor.execute(f"INSERT OR REPLACE INTO crm_pool_stats (run_id, recorded_at, {', '.join(POOL_COLUMNS)}) VALUES ({', '.join(['?'] * (len(POOL_COLUMNS) + 2))})",
+                       [run_id, datetime.now().isoformat(timespec='seconds')] + [stats.get(column, 0) for column in POOL_COLUMNS])
+
+def get_pool_history(limit=50):
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        create_pool_stats(cursor)
+
+        return pd.read_sql_query("SELECT * FROM crm_pool_stats ORDER BY recorded_at DESC LIMIT ?", conn, params=[limit])
+
+# Versione dei dati di ogni tabella, incrementata a ogni scrittura: invalida la cache dei risultati
+# degli analyzer anche quando l'aggiornamento gira in un altro processo (ingest.py)
+def create_data_versions(cursor):
+    cursor.execute('''CREATE TABLE IF NOT EXISTS data_versions
+                    (table_name TEXT PRIMARY KEY, 
+                    version INTEGER, 
+                    updated_at TEXT)''')
+
+def bump_data_version(cursor, table_name):
+    create_data_versions(cursor)
+    cursor.execute("""INSERT INTO data_versions VALUES (?, 1, ?)
+                    ON CONFLICT (table_name) DO UPDATE SET version = version + 1, updated_at = excluded.updated_at""",
+                   [table_name, datetime.now().isoformat(timespec='seconds')])
+
+def get_data_versions(table_names):
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        create_data_versions(cursor)
+        cursor.execute(f"SELECT table_name, version FROM data_versions WHERE table_name IN ({', '.join(['?'] * len(table_names))})", table_names)
+        versions = dict(cursor.fetchall())
+
+    return tuple(versions.get(table_name, 0) for table_name in table_names)
+
+def get_completed_chunks(source, account_id):
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        create_sync_state(cursor)
+        cursor.execute("SELECT chunk_start, chunk_end FROM sync_chunks WHERE source = ? AND account_id = ?", [source, account_id])
+
+        return {(date.fromisoformat(start), date.fromisoformat(end)) for start, end in cursor.fetchall()}
+
+def mark_chunk_completed(source, account_id, chunk_start, chunk_end):
+    with _write_lock, get_connection() as conn:
+        cursor = conn.cursor()
+        create_sync_state(cursor)
+        cursor.execute("INSERT OR REPLACE INTO sync_chunks (source, account_id, chunk_start, chunk_end, completed_at) VALUES (?, ?, ?, ?, ?)",
+                       [source, account_id, str(chunk_start), str(chunk_end), datetime.now().isoformat(timespec='seconds')])
+
+def clear_completed_chunks(source, account_id):
+    with _write_lock, get_connection() as conn:
+        cursor = conn.cursor()
+        create_sync_state(cursor)
+        cursor.execute("DELETE FROM sync_chunks WHERE source = ? AND account_id = ?", [source, account_id])
+
+def clear_stale_chunks(source, account_id, start_date, end_date):
+    with _write_lock, get_connection() as conn:
+        cursor = conn.cursor()
+        create_sync_state(cursor)
+        cursor.execute("DELETE FROM sync_chunks WHERE source = ? AND account_id = ? AND (chunk_end < ? OR chunk_start > ?)",
+                       [source, account_id, str(start_date), str(end_date)])
+
+def clear_sync_state(cursor, table_name):
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name IN ('sync_state', 'sync_chunks')")
+    for (sync_table,) in cursor.fetchall():
+        cursor.execute(f"DELETE FROM {sync_table} WHERE source = ?", [table_name])
 
 def save_to_database(df, table_name, is_api=True):
-    conn = sqlite3.connect('local_data.db')
-    cursor = conn.cursor()
-    
-    if is_api:
-        if table_name == 'facebook_data':
-            key_columns = ['date', 'campaign', 'adset_name', 'ad_name', 'age', 'gender']
-        elif table_name == 'google_ads_data':
-            key_columns = ['date', 'campaign']
-        elif table_name == 'tiktok_data':
-            key_columns = ['date', 'campaign', 'ad_group_name', 'ad_name']
-        elif table_name == 'googleanalytics4_data':
-            key_columns = ['date', 'campaign']
-        else:
-            st.warning(f"Tabella {table_name} non supportata nella funzione save_to_database. I dati potrebbero non essere salvati correttamente.")
-            key_columns = ['date', 'campaign']
+    key_columns = get_key_columns(table_name, is_api)
+
+    # SQLite considera distinti i NULL in un indice univoco: le chiavi mancanti diventano stringhe vuote
+    df = df.drop_duplicates(subset=key_columns, keep='last')
+    df = df.assign(**{col: df[col].fillna('') for col in key_columns})
 
-        cursor.execute(f"SELECT {', '.join(key_columns)} FROM {table_name}")
+    update_columns = [col for col in df.columns if col not in key_columns]
+    if update_columns:
+        conflict_action = "UPDATE SET " + ", ".join([f"{col} = excluded.{col}" for col in update_columns])
     else:
-        key_columns = ['id']
-        cursor.execute(f"SELECT id FROM {table_name}")
-
-    existing_data = set(tuple(row) for row in cursor.fetchall())
-
-    for _, row in df.iterrows():
-        key = tuple(row[col] for col in key_columns)
-        key_str = tuple(str(k) for k in key)
-        if key_str in existing_data:
-            update_query = f"UPDATE {table_name} SET "
-            update_query += ", ".join([f"{col} = ?" for col in df.columns if col not in key_columns])
-            update_query += f" WHERE {' AND '.join([f'{col} = ?' for col in key_columns])}"
-            update_values = [row[col] for col in df.columns if col not in key_columns] + list(key)
-            cursor.execute(update_query, update_values)
+        conflict_action = "NOTHING"
+
+    upsert_query = f"""INSERT INTO {table_name} ({', '.join(df.columns)})
+                    VALUES ({', '.join(['?' for _ in df.columns])})
+                    ON CONFLICT ({', '.join(key_columns)}) DO {conflict_action}"""
+
+    # Il tempo di scrittura parte dopo il lock: l'attesa dietro le altre fonti non è scrittura
+    with _write_lock, timed(table_name, 'write'), get_connection() as conn:
+        cursor = conn.cursor()
+        ensure_unique_key(cursor, table_name, key_columns)
+        touched_days = get_touched_days(cursor, table_name, df)
+        existing = count_existing_keys(cursor, table_name, key_columns, df)
+
+        cursor.executemany(upsert_query, df.itertuples(index=False, name=None))
+
+        refresh_daily_summary(cursor, table_name, touched_days)
+        bump_data_version(cursor, table_name)
+
+    inserted = len(df) - existing
+    record_metrics(table_name, rows_written=len(df))
+
+    return inserted, len(df) - inserted
+
+FILTER_OPERATORS = ['=', '!=', '<', '<=', '>', '>=', 'IN', 'NOT IN', 'LIKE', 'NOT LIKE', 'GLOB', 'NOT GLOB', 'IS NULL', 'IS NOT NULL']
+
+def build_filters(filters):
+    clauses = []
+    params = []
+
+    for column, operator, value in filters:
+        operator = operator.upper()
+        if operator not in FILTER_OPERATORS:
+            raise ValueError(f"Operatore di filtro non supportato: {operator}")
+
+        if operator in ('IN', 'NOT IN'):
+            clauses.append(f"{column} {operator} ({', '.join(['?' for _ in value])})")
+            params.extend(value)
+        elif operator in ('IS NULL', 'IS NOT NULL'):
+            clauses.append(f"{column} {operator}")
         else:
-            insert_query = f"INSERT INTO {table_name} ({', '.join(df.columns)}) VALUES ({', '.join(['?' for _ in df.columns])})"
-            cursor.execute(insert_query, row.tolist())
-        
-        existing_data.add(key_str)
+            clauses.append(f"{column} {operator} ?")
+            params.append(value)
 
-    conn.commit()
-    conn.close()
+    return clauses, params
 
-def get_data(table_name, start_date, end_date, custom_date_field='date'):
-    conn = sqlite3.connect('local_data.db')
+def get_data(table_name, start_date, end_date, custom_date_field='date', columns=None, filters=None):
+    # columns e filters (tuple colonna, operatore, valore) vengono risolti da SQLite,
+    # così in pandas arrivano solo le righe e le colonne usate dagli analyzer
+    clauses, params = build_filters(filters or [])
+    where = " AND ".join([f"{custom_date_field} BETWEEN ? AND ?"] + clauses)
 
-    query = f"SELECT * FROM {table_name} WHERE {custom_date_field} BETWEEN ? AND ?"
-    df = pd.read_sql_query(query, conn, params=(start_date, end_date))
-    
-    conn.close()
+    query = f"SELECT {', '.join(columns) if columns else '*'} FROM {table_name} WHERE {where}"
+
+    with get_connection() as conn:
+        df = pd.read_sql_query(query, conn, params=[start_date, end_date] + params)
     
+    return apply_dtypes(df, table_name)
+
+def apply_dtypes(df, table_name):
+    for column, dtype in DTYPES.get(table_name, {}).items():
+        if column not in df.columns:
+            continue
+
+        if dtype == 'date':
+            df[column] = pd.to_datetime(df[column], errors='coerce')
+        elif dtype == 'count':
+            df[column] = pd.to_numeric(df[column].fillna(0), downcast='integer')
+        else:
+            df[column] = df[column].astype(dtype)
+
     return df
 
-def show_table_data(table_name, start_date, end_date, custom_date_field='date'):
-    env = environ.Env()
-    environ.Env.read_env()
-    
+def get_table_summary(table_name, date_field, filters):
+    clauses, params = build_filters(filters)
+
+    with get_connection() as conn:
+        cursor = conn.execute(f"SELECT COUNT(*), MIN({date_field}), MAX({date_field}) FROM {table_name} WHERE {' AND '.join(clauses)}", params)
+        return cursor.fetchone()
+
+def get_table_page(table_name, filters, key_columns, after=None, page_size=100):
+    # Paginazione keyset: la pagina successiva riparte dalla chiave dell'ultima riga mostrata,
+    # così SQLite scorre l'indice della chiave invece di saltare OFFSET righe
+    clauses, params = build_filters(filters)
+    if after is not None:
+        clauses.append(f"({', '.join(key_columns)}) > ({', '.join(['?' for _ in key_columns])})")
+        params.extend(after)
+
+    query = f"""SELECT rowid AS _rowid, * FROM {table_name}
+                WHERE {' AND '.join(clauses)}
+                ORDER BY {', '.join(key_columns)}
+                LIMIT ?"""
+
+    with get_connection() as conn:
+        df = pd.read_sql_query(query, conn, params=params + [page_size + 1])
+
+    has_next = len(df) > page_size
+    df = df.head(page_size)
+    cursor_columns = ['_rowid' if col == 'rowid' else col for col in key_columns]
+    # Valori Python nativi: sqlite3 passerebbe un numpy.int64 come BLOB e il confronto con rowid fallirebbe
+    last_key = [getattr(value, 'item', lambda: value)() for value in df.iloc[-1][cursor_columns]] if not df.empty else None
+
+    return df.drop(columns='_rowid'), last_key, has_next
+
+def show_table_data(table_name, start_date, end_date, custom_date_field='date', page_size=100):
     source = table_name.removesuffix("_data")
     if custom_date_field == 'date':
         account_id_key = f"{source}_account_id"
-        account_id = env(account_id_key)
+        account_id = env(account_id_key, default=None)
     else:
         account_id = None
 
-    conn = sqlite3.connect('local_data.db')
-    
-    cursor = conn.cursor()
-    cursor.execute(f"PRAGMA table_info({table_name})")
-    
-    schema_info = cursor.fetchall()
-    schema_df = pd.DataFrame(schema_info, columns=['id', 'nome', 'tipo', 'notnull', 'dflt_value', 'pk'])
-
-    if account_id:
-        data_df = pd.read_sql_query(f"SELECT * FROM {table_name} WHERE account_id = ? AND {custom_date_field} BETWEEN ? AND ?", conn, params=(account_id, start_date, end_date))
-    else:
-        data_df = pd.read_sql_query(f"SELECT * FROM {table_name} WHERE {custom_date_field} BETWEEN ? AND ?", conn, params=(start_date, end_date))
-    
-    conn.close()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"PRAGMA table_info({table_name})")
+        
+        schema_info = cursor.fetchall()
+        schema_df = pd.DataFrame(schema_info, columns=['id', 'nome', 'tipo', 'notnull', 'dflt_value', 'pk'])
     
     st.subheader("Struttura della tabella")
     st.dataframe(schema_df, column_order=['id', 'nome', 'tipo'], use_container_width=True, hide_index=True)
 
     st.subheader("Dati della tabella")
-    st.dataframe(data_df, use_container_width=True, hide_index=True)
\ No newline at end of file
+
+    filters = [(custom_date_field, '>=', str(start_date)), (custom_date_field, '<=', str(end_date))]
+    if account_id:
+        filters.append(('account_id', '=', account_id))
+
+    col1, col2 = st.columns(2)
+    with col1:
+        filter_column = st.selectbox("Filtra per colonna", ['Nessun filtro'] + schema_df['nome'].tolist(), key=f"filtro_colonna_{table_name}")
+    with col2:
+        filter_value = st.text_input("Valore del filtro", value="", key=f"filtro_valore_{table_name}")
+
+    if filter_column != 'Nessun filtro' and filter_value:
+        filters.append((filter_column, 'LIKE', f"%{filter_value}%"))
+
+    total_rows, min_date, max_date = get_table_summary(table_name, custom_date_field, filters)
+    st.caption(f"{total_rows} righe trovate" + (f" dal {min_date} al {max_date}" if total_rows else ""))
+
+    # Le chiavi di partenza delle pagine già visitate restano in sessione; cambiando filtri si riparte
+    key_columns = KEY_COLUMNS.get(table_name, ['rowid'])
+    state_key = f"pagine_{table_name}"
+    if st.session_state.get(state_key, {}).get('filters') != filters:
+        st.session_state[state_key] = {'filters': filters, 'cursors': [None], 'next': None}
+    pages = st.session_state[state_key]
+
+    data_df, last_key, has_next = get_table_page(table_name, filters, key_columns, pages['cursors'][-1], page_size)
+    pages['next'] = last_key
+
+    st.dataframe(data_df, use_container_width=True, hide_index=True)
+
+    def previous_page():
+        pages['cursors'].pop()
+
+    def next_page():
+        pages['cursors'].append(pages['next'])
+
+    col3, col4, col5 = st.columns([1,2,1])
+    with col3:
+        st.button("Pagina precedente", on_click=previous_page, disabled=len(pages['cursors']) == 1, use_container_width=True, key=f"pagina_precedente_{table_name}")
+    with col4:
+        st.caption(f"Pagina {len(pages['cursors'])} di {max(1, -(-total_rows // page_size))}")
+    with col5:
+        st.button("Pagina successiva", on_click=next_page, disabled=not has_next, use_container_width=True, key=f"pagina_successiva_{table_name}")
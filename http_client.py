@@ -0,0 +1,111 @@
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+import environ
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import HTTPError
+
+from metrics import record as record_metrics
+
+env = environ.Env()
+environ.Env.read_env()
+
+POOL_SIZE = env.int('http_pool_size', default=16)
+CONNECT_TIMEOUT = env.float('api_connect_timeout', default=10)
+READ_TIMEOUT = env.float('api_read_timeout', default=300)
+
+# Errori di rete da ritentare. La lettura a blocchi di response.raw solleva le eccezioni di urllib3
+# e ConnectionError/TimeoutError di Python, non quelle di requests
+TRANSIENT_ERRORS = (requests.ConnectionError, requests.Timeout, HTTPError, ConnectionError, TimeoutError)
+RETRY_STATUS = 429
+
+def is_transient(error):
+    # Le risposte 4xx (chiave non valida, connettore sbagliato) falliscono subito: ritentarle non serve
+    if isinstance(error, requests.HTTPError):
+        status = error.response.status_code if error.response is not None else None
+        return status is not None and (status >= 500 or status == RETRY_STATUS)
+
+    return isinstance(error, TRANSIENT_ERRORS)
+
+_session = None
+_session_lock = threading.Lock()
+
+# Richieste di ogni fonte, raccolte a fine fonte da run_ingestion come i tempi di metrics
+_stats = defaultdict(list)
+_stats_lock = threading.Lock()
+
+def get_session():
+    # Una sola sessione per processo: le connessioni keep-alive vengono riusate tra blocchi e fonti
+    global _session
+
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers.update({'Accept-Encoding': 'gzip, deflate', 'Accept': 'application/json'})
+            _session = session
+
+    return _session
+
+@contextmanager
+def stream(url, params=None, label=None):
+    # Restituisce il corpo della risposta come file già decompresso, da leggere a blocchi
+    started = time.perf_counter()
+    status, first_byte, error = None, None, None
+    response = None
+
+    try:
+        response = get_session().get(url, params=params, stream=True, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+        status = response.status_code
+        first_byte = time.perf_counter() - started
+        response.raise_for_status()
+
+        response.raw.decode_content = True
+        yield response.raw
+    except Exception as e:
+        error = type(e).__name__
+        raise
+    finally:
+        if response is not None:
+            received = response.raw.tell()
+            response.close()
+        else:
+            received = 0
+
+        # Il tempo di rete delle fasi viene misurato solo sulle letture del corpo, in iter_json_records
+        record_metrics(label or url, bytes=received)
+
+        with _stats_lock:
+            _stats[label or url].append({
+                'stato': status,
+                'errore': error,
+                'primo_byte_s': first_byte,
+                'totale_s': time.perf_counter() - started,
+                'byte_ricevuti': received,
+                'compressa': response is not None and response.headers.get('Content-Encoding') == 'gzip'
+            })
+
+def collect_request_stats(label):
+    with _stats_lock:
+        requests_made = _stats.pop(label, [])
+
+    if not requests_made:
+        return None
+
+    first_bytes = [request['primo_byte_s'] for request in requests_made if request['primo_byte_s'] is not None]
+    totals = [request['totale_s'] for request in requests_made]
+
+    return {
+        'richieste': len(requests_made),
+        'errori': sum(request['errore'] is not None for request in requests_made),
+        'byte_ricevuti': sum(request['byte_ricevuti'] for request in requests_made),
+        'compresse': sum(request['compressa'] for request in requests_made),
+        'primo_byte_medio_s': sum(first_bytes) / len(first_bytes) if first_bytes else None,
+        'primo_byte_max_s': max(first_bytes, default=None),
+        'totale_medio_s': sum(totals) / len(totals),
+        'totale_max_s': max(totals)
+    }
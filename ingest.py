@@ -0,0 +1,88 @@
+# Aggiornamento dei dati fuori da Streamlit, da lanciare a mano o da cron:
+#
+#   python ingest.py                      # ultimi 28 giorni fino a ieri, tutte le fonti
+#   python ingest.py --tables opp_data --crm-changes
+#   python ingest.py --every 60           # resta attivo e aggiorna ogni ora
+#   python ingest.py --replay             # ricostruisce le tabelle da raw_cache, senza rete
+import argparse
+import sys
+import time
+import traceback
+from datetime import date, timedelta
+import environ
+
+from db import initialize_database
+from ingestion import build_tasks, build_replay_tasks, run_ingestion, ingestion_lock, IngestionLocked
+
+env = environ.Env()
+environ.Env.read_env()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Aggiorna il database locale da API e CRM")
+    parser.add_argument('--start', type=date.fromisoformat, help="Primo giorno (default: oggi meno --days)")
+    parser.add_argument('--end', type=date.fromisoformat, help="Ultimo giorno (default: ieri)")
+    parser.add_argument('--days', type=int, default=env.int('ingest_days', default=28))
+    parser.add_argument('--tables', nargs='+', help="Tabelle da aggiornare (default: tutte)")
+    parser.add_argument('--opp-date', default='createdAt', choices=['createdAt', 'lastStageChangeAt'])
+    parser.add_argument('--lead-date', default='data_acquisizione', choices=['data_acquisizione', 'createdAt', 'lastStageChangeAt'])
+    parser.add_argument('--full', action='store_true', help="Ignora i giorni già sincronizzati")
+    parser.add_argument('--crm-changes', action='store_true', help="CRM per modifiche invece che per periodo")
+    parser.add_argument('--every', type=int, help="Minuti tra un aggiornamento e il successivo")
+    parser.add_argument('--replay', action='store_true', help="Ricostruisce le tabelle dalle risposte salvate in raw_cache")
+    parser.add_argument('--trigger', default='cli')
+
+    return parser.parse_args()
+
+def ingest(args):
+    end_date = args.end or date.today() - timedelta(days=1)
+    start_date = args.start or end_date - timedelta(days=args.days - 1)
+
+    if args.replay:
+        tasks = build_replay_tasks(args.tables)
+    else:
+        tasks = build_tasks(start_date, end_date, args.opp_date, args.lead_date, args.full, args.crm_changes, args.tables)
+
+    # Lanciato da cron può trovare un database nuovo o di una versione precedente: tabelle di
+    # servizio, riepiloghi e migrazioni prima del lock e di qualsiasi fonte
+    initialize_database()
+
+    failures = 0
+    with ingestion_lock():
+        if args.replay:
+            print(f"Ricostruzione dalla cache: {', '.join(tasks) or 'nessuna risposta salvata'}", flush=True)
+        else:
+            print(f"Aggiornamento dal {start_date} al {end_date}: {', '.join(tasks)}", flush=True)
+
+        for label, result, error in run_ingestion(tasks, 'replay' if args.replay else args.trigger):
+            if error:
+                failures += 1
+                print(f"{label}: errore, {error}", flush=True)
+            elif result is None:
+                print(f"{label}: già aggiornato", flush=True)
+            else:
+                print(f"{label}: {result[0]} righe inserite, {result[1]} aggiornate", flush=True)
+
+    return failures
+
+def main():
+    args = parse_args()
+
+    while True:
+        try:
+            failures = ingest(args)
+        except IngestionLocked as e:
+            print(e, flush=True)
+            failures = 1
+        except Exception as e:
+            # Con --every un errore fuori dalle fonti (schema, database bloccato) non ferma il processo
+            print(f"Aggiornamento interrotto: {type(e).__name__}: {e}", flush=True)
+            traceback.print_exc()
+            failures = 1
+
+        if not args.every:
+            sys.exit(1 if failures else 0)
+
+        time.sleep(args.every * 60)
+
+if __name__ == '__main__':
+    main()
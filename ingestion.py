@@ -0,0 +1,148 @@
+import os
+import subprocess
+import sys
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+import environ
+
+from config import FIELDS
+from crm_pool import get_pool, get_pool_stats
+from db import log_sync, log_metrics, log_request_stats, log_pool_stats
+from http_client import collect_request_stats
+from metrics import timed, collect, record as record_metrics
+from raw_cache import cached_tables
+from data_retrieval import api_retrieve_data, opp_retrieving, attribution_retrieving, transaction_retrieving, changes_retrieving, replay_cached, refresh_sources
+
+env = environ.Env()
+environ.Env.read_env()
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+LOCK_FILE = env('ingest_lock_file', default=os.path.join(BASE_DIR, 'ingest.lock'))
+LOG_FILE = env('ingest_log_file', default=os.path.join(BASE_DIR, 'ingest.log'))
+
+CRM_TABLES = ['opp_data', 'attribution_data', 'transaction_data']
+
+SOURCE_TABLES = [f"{source}_data" for source in FIELDS] + CRM_TABLES
+
+class IngestionLocked(Exception):
+    pass
+
+def build_tasks(start_date, end_date, update_type_opp='createdAt', update_type_attribution='data_acquisizione',
+                full_refresh=False, crm_changes=False, tables=None):
+    # Le stesse pipeline della pagina Impostazioni, indicizzate per tabella di destinazione
+    pipelines = {}
+
+    for source, fields in FIELDS.items():
+        pipelines[f"{source}_data"] = lambda source=source, fields=fields: api_retrieve_data(source, fields, start_date, end_date, full_refresh)
+
+    if crm_changes:
+        for table_name in CRM_TABLES:
+            pipelines[table_name] = lambda table_name=table_name: changes_retrieving(get_pool(), table_name, full_refresh)
+    else:
+        pipelines['opp_data'] = lambda: opp_retrieving(get_pool(), update_type_opp, start_date, end_date)
+        pipelines['attribution_data'] = lambda: attribution_retrieving(get_pool(), update_type_attribution, start_date, end_date)
+        pipelines['transaction_data'] = lambda: transaction_retrieving(get_pool(), start_date, end_date)
+
+    unknown = set(tables or []) - set(pipelines)
+    if unknown:
+        raise ValueError(f"Tabelle senza una fonte da cui aggiornarsi: {', '.join(sorted(unknown))}")
+
+    return {table_name: task for table_name, task in pipelines.items() if not tables or table_name in tables}
+
+def build_replay_tasks(tables=None):
+    # Rilettura di raw_cache: nessuna richiesta ad API o CRM
+    unknown = set(tables or []) - set(SOURCE_TABLES)
+    if unknown:
+        raise ValueError(f"Tabelle senza una fonte da cui aggiornarsi: {', '.join(sorted(unknown))}")
+
+    return {
+        table_name: lambda table_name=table_name: replay_cached(table_name)
+        for table_name in cached_tables()
+        if table_name in SOURCE_TABLES and (not tables or table_name in tables)
+    }
+
+def run_ingestion(tasks, trigger='manuale'):
+    # Registra in sync_log lo stato di ogni tabella (in corso, poi l'esito) e in ingest_metrics i suoi tempi, man mano che termina
+    run_id = uuid.uuid4().hex
+    started_at = datetime.now().isoformat(timespec='seconds')
+
+    for table_name in tasks:
+        collect(table_name)
+        collect_request_stats(table_name)
+        log_sync(run_id, trigger, table_name, started_at, 'in corso')
+
+    measured = {table_name: (lambda table_name=table_name, task=task: measure(table_name, task)) for table_name, task in tasks.items()}
+
+    for table_name, result, error in refresh_sources(measured):
+        if error:
+            record_metrics(table_name, errors=1)
+            log_sync(run_id, trigger, table_name, started_at, 'errore', error=str(error))
+        elif result is None:
+            log_sync(run_id, trigger, table_name, started_at, 'già aggiornato')
+        else:
+            log_sync(run_id, trigger, table_name, started_at, 'ok', *result)
+
+        log_metrics(run_id, table_name, collect(table_name))
+
+        request_stats = collect_request_stats(table_name)
+        if request_stats is not None:
+            log_request_stats(run_id, table_name, request_stats)
+
+        yield table_name, result, error
+
+    # Il pool esiste solo se qualche fonte ha interrogato il CRM; i contatori valgono dall'avvio del processo
+    pool_stats = get_pool_stats()
+    if pool_stats is not None:
+        log_pool_stats(run_id, pool_stats)
+
+def measure(table_name, task):
+    with timed(table_name, 'total'):
+        return task()
+
+@contextmanager
+def ingestion_lock(path=LOCK_FILE):
+    # File di lock con il pid del processo: un lock rimasto da un processo terminato viene recuperato
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        if lock_owner_alive(path):
+            raise IngestionLocked(f"Aggiornamento già in corso (lock {path})")
+        os.remove(path)
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+
+    with os.fdopen(fd, 'w') as lock:
+        lock.write(str(os.getpid()))
+
+    try:
+        yield
+    finally:
+        os.remove(path)
+
+def lock_owner_alive(path=LOCK_FILE):
+    try:
+        with open(path) as lock:
+            pid = int(lock.read())
+    except FileNotFoundError:
+        return False
+    except ValueError:
+        # Lock appena creato da un altro processo che non ha ancora scritto il pid
+        return True
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+def is_running(path=LOCK_FILE):
+    return os.path.exists(path) and lock_owner_alive(path)
+
+def start_background(args):
+    # La dashboard non scarica nulla: lancia ingest.py in un processo separato, che prepara lo schema e scrive il database
+    with open(LOG_FILE, 'a') as log:
+        return subprocess.Popen([sys.executable, os.path.join(BASE_DIR, 'ingest.py'), *args], cwd=BASE_DIR,
+                                stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
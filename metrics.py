@@ -0,0 +1,25 @@
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# Totali per tabella accumulati dai thread di download e scrittura e raccolti a fine fonte da run_ingestion
+_totals = defaultdict(lambda: defaultdict(float))
+_lock = threading.Lock()
+
+def record(source, **values):
+    with _lock:
+        for name, value in values.items():
+            _totals[source][name] += value
+
+@contextmanager
+def timed(source, phase):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(source, **{f"{phase}_s": time.perf_counter() - started})
+
+def collect(source):
+    with _lock:
+        return dict(_totals.pop(source, {}))
@@ -85,14 +85,14 @@ st.session_state['lead_radio'] = lead_radio
 # Data processing
 # ------------------------------
 try:
-    meta_analyzer = MetaAnalyzer(start_date, end_date, comparison_start, comparison_end)
+    meta_analyzer = MetaAnalyzer(start_date, end_date, comparison_start, comparison_end, detail=False)
     meta_results, meta_results_comp = meta_analyzer.analyze()
 except Exception as e:
     st.warning(f"Errore nell'elaborazione dei dati di Meta: {str(e)}")
     meta_results, meta_results_comp = {}, {}
 
 try:
-    gads_analyzer = GadsAnalyzer(start_date, end_date, comparison_start, comparison_end)
+    gads_analyzer = GadsAnalyzer(start_date, end_date, comparison_start, comparison_end, detail=False)
     gads_results, gads_results_comp = gads_analyzer.analyze()
 except Exception as e:
     st.warning(f"Errore nell'elaborazione dei dati di Google Ads: {str(e)}")
@@ -101,6 +101,9 @@ except Exception as e:
 try:
     opp_analyzer = OppAnalyzer(start_date, end_date, comparison_start, comparison_end, update_type_opp)
     opp_results, opp_results_comp = opp_analyzer.analyze()
+
+    if opp_results['stage_non_mappati']:
+        st.warning(f"Stage non presenti in config.STAGES, esclusi dai conteggi per categoria: {', '.join(opp_results['stage_non_mappati'])}")
 except Exception as e:
     st.warning(f"Errore nell'elaborazione dei dati da opportunità: {str(e)}")
     opp_results, opp_results_comp = {}, {}
@@ -1,12 +1,10 @@
 import streamlit as st
-import environ
+import time
 from datetime import datetime, timedelta
-import sqlite3
-import mysql.connector
 
-from config import STAGES, FIELDS
-from db import initialize_database, delete_table, show_table_data, add_column, delete_column, delete_table_data
-from data_retrieval import api_retrieve_data, opp_retrieving, attribution_retrieving, transaction_retrieving
+from db import initialize_database, delete_table, show_table_data, add_column, delete_column, delete_table_data, get_tables, get_sync_log, get_sync_progress, get_ingest_history, get_request_history, get_pool_history
+from ingestion import SOURCE_TABLES, start_background, is_running
+from result_cache import get_cache_stats, clear_cache
 
 # ------------------------------
 #             SIDEBAR
@@ -64,21 +62,18 @@ with col2:
 with col3:
     database_delete = st.button("Elimina tutte le tabelle", use_container_width=True)
 with col4:
-    pass
+    full_refresh = st.checkbox("Aggiornamento completo", help="Scarica di nuovo l'intero periodo ignorando i giorni già sincronizzati")
+    crm_changes = st.checkbox("CRM per modifiche", help="Scarica dal CRM solo opportunità e pagamenti modificati dall'ultimo aggiornamento, qualunque sia il periodo selezionato")
 
 st.subheader("Gestione delle tabelle singole")
 
-conn = sqlite3.connect('local_data.db')
-cursor = conn.cursor()
-cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-tabelle = [row[0] for row in cursor.fetchall()]
-conn.close()
+tabelle = get_tables()
 
 col5, col6 = st.columns([1,1])
 with col5:
     tabella_selezionata = st.selectbox("Seleziona una tabella", tabelle if tabelle else ['Database vuoto'], disabled=(not tabelle))
 with col6:
-    pass
+    ricostruisci_tabella = st.button("Ricostruisci dalla cache", use_container_width=True, help="Rielabora le risposte già scaricate senza interrogare API e CRM")
 
 col7, col8, col9, col10 = st.columns([1,1,1,1])
 with col7:
@@ -127,32 +122,28 @@ st.session_state['end_date'] = end_date
 st.session_state['opp_radio'] = opp_radio
 st.session_state['lead_radio'] = lead_radio
 
-# Database connection
-# ------------------------------
-env = environ.Env()
-environ.Env.read_env()
-
-pool = mysql.connector.pooling.MySQLConnectionPool(
-    pool_name="mypool",
-    pool_size=5,
-    host=env('host'),
-    port=env('port'),
-    user=env('username'),
-    password=env('password'),
-    database=env('database'),
-    auth_plugin='caching_sha2_password')
-
-# Data sources
-# ------------------------------
-data_sources = [
-    ('facebook', FIELDS['facebook']),
-    ('google_ads', FIELDS['google_ads']),
-    ('tiktok', FIELDS['tiktok']),
-    ('googleanalytics4', FIELDS['googleanalytics4']),
-]
-
 # Funzioni dei bottoni
 # ------------------------------
+def start_refresh(tables=None):
+    # Il download gira in un processo separato (ingest.py): la sessione resta libera
+    # e la dashboard legge soltanto il database locale
+    if is_running():
+        st.warning("Un aggiornamento è già in corso, attendi che termini")
+        return
+
+    args = ['--start', str(comparison_start), '--end', str(end_date),
+            '--opp-date', update_type_opp, '--lead-date', update_type_attribution, '--trigger', 'dashboard']
+    if full_refresh:
+        args.append('--full')
+    if crm_changes:
+        args.append('--crm-changes')
+    if tables:
+        args += ['--tables', *tables]
+
+    start_background(args)
+    st.session_state['aggiornamento_avviato'] = time.time()
+    st.info("Aggiornamento avviato in background: l'avanzamento compare nel registro degli aggiornamenti")
+
 if database_inizialize:
     try:
         initialize_database()
@@ -162,12 +153,7 @@ if database_inizialize:
 
 if database_update:
     if tabelle:
-        for source, fields in data_sources:
-            api_retrieve_data(source, fields, comparison_start, end_date)
-        
-        opp_retrieving(pool, update_type_opp, comparison_start, end_date)
-        attribution_retrieving(pool, update_type_attribution, comparison_start, end_date)
-        transaction_retrieving(pool, comparison_start, end_date)
+        start_refresh()
     else:
         st.error("Inizializza il database per poter utilizzare questa funzione")
 
@@ -180,36 +166,35 @@ if database_delete:
             st.error(f"Errore durante l'eliminazione della tabella: {str(e)}")
 
 if aggiorna_tabella:
-    retrieval_mapping = {
-        "opp_data": lambda: opp_retrieving(pool, update_type_opp, comparison_start, end_date),
-        "attribution_data": lambda: attribution_retrieving(pool, update_type_attribution, comparison_start, end_date),
-        "transaction_data": lambda: transaction_retrieving(pool, comparison_start, end_date)
-    }
-
     if tabella_selezionata == "Database vuoto":
         st.error("Inizializza il database per poter utilizzare questa funzione")
-    elif tabella_selezionata in retrieval_mapping:
-        try:
-            retrieval_mapping[tabella_selezionata]()
-        except Exception as e:
-            st.error(f"Errore durante l'aggiornamento della tabella: {str(e)}")
+    elif tabella_selezionata in SOURCE_TABLES:
+        start_refresh([tabella_selezionata])
     else:
-        source = tabella_selezionata.removesuffix("_data")
-        fields = FIELDS[source]
+        st.error(f"La tabella {tabella_selezionata} non ha una fonte da cui aggiornarsi")
 
-        try:
-            api_retrieve_data(source, fields, comparison_start, end_date)
-        except Exception as e:
-            st.error(f"Errore durante l'aggiornamento della tabella: {str(e)}")
+if ricostruisci_tabella:
+    if tabella_selezionata not in SOURCE_TABLES:
+        st.error(f"La tabella {tabella_selezionata} non ha una fonte da cui aggiornarsi")
+    elif is_running():
+        st.warning("Un aggiornamento è già in corso, attendi che termini")
+    else:
+        start_background(['--replay', '--tables', tabella_selezionata, '--trigger', 'dashboard'])
+        st.session_state['aggiornamento_avviato'] = time.time()
+        st.info("Ricostruzione avviata in background: l'avanzamento compare nel registro degli aggiornamenti")
 
 if mostra_tabella:
     if tabella_selezionata == "Database vuoto":
         st.error("Inizializza il database per poter utilizzare questa funzione")
     else:
-        if tabella_selezionata in ['opp_data', 'attribution_data', 'transaction_data']:
-            show_table_data(tabella_selezionata, start_date, end_date, update_type_opp)
-        else:
-            show_table_data(tabella_selezionata, start_date, end_date)
+        st.session_state['tabella_visualizzata'] = tabella_selezionata
+
+# La tabella resta visibile tra un rerun e l'altro per poterne sfogliare le pagine
+if st.session_state.get('tabella_visualizzata') == tabella_selezionata:
+    if tabella_selezionata in ['opp_data', 'attribution_data', 'transaction_data']:
+        show_table_data(tabella_selezionata, start_date, end_date, update_type_opp)
+    else:
+        show_table_data(tabella_selezionata, start_date, end_date)
 
 if elimina_dati_tabella:
     if tabella_selezionata == "Database vuoto":
@@ -233,4 +218,72 @@ if delete_column_button:
     if column_name:
         delete_column(tabella_selezionata, column_name)
     else:
-        st.error("Inserisci il nome della colonna da eliminare")
\ No newline at end of file
+        st.error("Inserisci il nome della colonna da eliminare")
+
+# Registro degli aggiornamenti
+# ------------------------------
+st.subheader("Registro degli aggiornamenti")
+
+def show_progress():
+    # Il processo di ingest.py impiega qualche secondo a prendere il lock dopo l'avvio
+    if not is_running() and time.time() - st.session_state.get('aggiornamento_avviato', 0) > 30:
+        st.rerun()
+
+    st.info("Aggiornamento in corso: lo stato delle fonti si aggiorna ogni 5 secondi")
+    st.dataframe(get_sync_progress(), use_container_width=True, hide_index=True)
+
+# Avanzamento per fonte letto da sync_log e sync_chunks mentre ingest.py lavora; al termine la pagina si ricarica
+if is_running() or time.time() - st.session_state.get('aggiornamento_avviato', 0) <= 30:
+    st.fragment(show_progress, run_every=5)()
+
+if tabelle:
+    st.dataframe(get_sync_log(), use_container_width=True, hide_index=True)
+
+    # Storico dei tempi per fase: un rallentamento di una fonte si vede nel grafico
+    storico = get_ingest_history()
+    if not storico.empty:
+        st.subheader("Prestazioni degli aggiornamenti")
+
+        storico['righe_al_secondo'] = storico['rows_written'] / storico['total_s'].where(storico['total_s'] > 0)
+        fase = st.selectbox("Metrica", ['total_s', 'network_s', 'parse_s', 'transform_s', 'write_s', 'righe_al_secondo', 'bytes', 'errors'])
+
+        st.line_chart(storico.pivot_table(index='finished_at', columns='source', values=fase, aggfunc='sum'))
+        st.dataframe(storico, use_container_width=True, hide_index=True)
+
+    # Richieste alle API salvate da ingest.py per fonte e aggiornamento
+    richieste = get_request_history()
+    if not richieste.empty:
+        ultime = richieste[richieste['run_id'] == richieste['run_id'].iloc[0]]
+        with st.expander(f"Richieste HTTP dell'ultimo aggiornamento: {int(ultime['richieste'].sum())}, {ultime['byte_ricevuti'].sum() / 1e6:.1f} MB ricevuti"):
+            st.dataframe(richieste.drop(columns='run_id'), use_container_width=True, hide_index=True)
+
+# Cache dei risultati delle analisi
+# ------------------------------
+st.subheader("Cache delle analisi")
+
+statistiche = get_cache_stats()
+col1, col2, col3, col4 = st.columns(4)
+col1.metric("Hit rate", f"{statistiche['hit_rate']:.0%}")
+col2.metric("Richieste", statistiche['hit'] + statistiche['miss'])
+col3.metric("Risultati in cache", statistiche['voci'])
+col4.metric("Memoria", f"{statistiche['mb_occupati']:.1f} / {statistiche['mb_massimi']:.0f} MB")
+
+if st.button("Svuota la cache delle analisi"):
+    clear_cache()
+    st.success("Cache delle analisi svuotata")
+
+# Pool di connessioni al CRM
+# ------------------------------
+# Il pool vive nel processo di ingest.py: i contatori arrivano dal database, uno per aggiornamento
+pool = get_pool_history()
+if not pool.empty:
+    st.subheader("Connessioni al CRM")
+
+    ultimo = pool.iloc[0]
+    col1, col2, col3, col4 = st.columns(4)
+    col1.metric("Connessioni riusate", f"{ultimo['connessioni_riusate'] / ultimo['acquisizioni']:.0%}" if ultimo['acquisizioni'] else "-")
+    col2.metric("Connessioni create", int(ultimo['connessioni_create']))
+    col3.metric("Attesa massima", f"{ultimo['attesa_massima_s']:.2f} s")
+    col4.metric("Scartate", int(ultimo['scadute'] + ultimo['ping_falliti'] + ultimo['risultati_pendenti']))
+
+    st.dataframe(pool, use_container_width=True, hide_index=True)
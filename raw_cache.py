@@ -0,0 +1,106 @@
+import glob
+import gzip
+import hashlib
+import json
+import os
+from contextlib import contextmanager
+from datetime import datetime
+import environ
+
+env = environ.Env()
+environ.Env.read_env()
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+RAW_CACHE_ENABLED = env.bool('raw_cache', default=True)
+RAW_CACHE_DIR = env('raw_cache_dir', default=os.path.join(BASE_DIR, 'raw_cache'))
+READ_CHUNK_SIZE = 1 << 16
+
+class TeeReader:
+    # Passa i byte letti al parser e li copia compressi nella cache
+    def __init__(self, stream, sink):
+        self.stream = stream
+        self.sink = sink
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.sink.write(data)
+        return data
+
+def cache_path(table_name, key):
+    # Indirizzata dal contenuto della richiesta: la stessa richiesta sovrascrive la stessa voce
+    digest = hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()[:24]
+    return os.path.join(RAW_CACHE_DIR, table_name, digest)
+
+@contextmanager
+def cache_entry(table_name, kind, key, meta):
+    # Scrive su un file temporaneo e lo rende visibile solo se l'estrazione va a buon fine
+    path = cache_path(table_name, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+
+    try:
+        with gzip.open(tmp_path, 'wb', compresslevel=5) as sink:
+            yield sink
+
+        os.replace(tmp_path, f"{path}.gz")
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    with open(f"{path}.json", 'w') as meta_file:
+        json.dump(dict(meta, table=table_name, kind=kind, key=key, fetched_at=datetime.now().isoformat()), meta_file, default=str)
+
+@contextmanager
+def cache_response(table_name, key, stream, meta):
+    if not RAW_CACHE_ENABLED:
+        yield stream
+        return
+
+    with cache_entry(table_name, 'api', key, meta) as sink:
+        reader = TeeReader(stream, sink)
+        yield reader
+
+        # Il parser si ferma alla fine dell'array data: il resto del corpo va comunque salvato
+        while reader.read(READ_CHUNK_SIZE):
+            pass
+
+@contextmanager
+def cache_rows(table_name, key, meta):
+    # Estrazioni dal CRM: una riga JSON con le colonne, poi una riga per ogni blocco di righe
+    if not RAW_CACHE_ENABLED:
+        yield lambda columns, rows: None
+        return
+
+    with cache_entry(table_name, 'crm', key, meta) as sink:
+        def write(columns, rows):
+            if sink.tell() == 0:
+                sink.write(json.dumps(list(columns)).encode() + b"\n")
+            sink.write(json.dumps(rows, default=str).encode() + b"\n")
+
+        yield write
+
+def iter_cached(table_name):
+    # Dal download più vecchio al più recente: le finestre sovrapposte finiscono con i dati più aggiornati
+    entries = []
+    for meta_path in glob.glob(os.path.join(RAW_CACHE_DIR, table_name, '*.json')):
+        if os.path.exists(meta_path.removesuffix('.json') + '.gz'):
+            with open(meta_path) as meta_file:
+                entries.append(dict(json.load(meta_file), path=meta_path.removesuffix('.json') + '.gz'))
+
+    return sorted(entries, key=lambda entry: entry['fetched_at'])
+
+def read_cached_rows(entry):
+    with gzip.open(entry['path'], 'rb') as cached:
+        columns = None
+        for line in cached:
+            if columns is None:
+                columns = json.loads(line)
+            else:
+                yield columns, json.loads(line)
+
+def cached_tables():
+    if not os.path.isdir(RAW_CACHE_DIR):
+        return []
+
+    return sorted(name for name in os.listdir(RAW_CACHE_DIR) if os.path.isdir(os.path.join(RAW_CACHE_DIR, name)))
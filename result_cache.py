@@ -0,0 +1,95 @@
+import copy
+import sys
+import threading
+from collections import OrderedDict
+import environ
+import pandas as pd
+
+env = environ.Env()
+environ.Env.read_env()
+
+CACHE_MB = env.int('result_cache_mb', default=256)
+
+def estimate_size(value):
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(deep=True))
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(estimate_size(k) + estimate_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(estimate_size(item) for item in value)
+
+    return sys.getsizeof(value)
+
+class ResultCache:
+    # LRU condivisa da tutte le sessioni del processo, con un tetto alla memoria occupata
+    def __init__(self, max_bytes=CACHE_MB * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {'hit': 0, 'miss': 0, 'scartati': 0, 'troppo_grandi': 0}
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                self.stats['miss'] += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.stats['hit'] += 1
+            value, _ = self._entries[key]
+
+        # Le pagine modificano i DataFrame ricevuti: ogni lettura riceve una copia
+        return copy.deepcopy(value)
+
+    def put(self, key, value):
+        size = estimate_size(value)
+        value = copy.deepcopy(value)
+
+        with self._lock:
+            if size > self.max_bytes:
+                self.stats['troppo_grandi'] += 1
+                return
+
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+
+            self._entries[key] = (value, size)
+            self._bytes += size
+
+            while self._bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= evicted
+                self.stats['scartati'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def get_stats(self):
+        with self._lock:
+            requests = self.stats['hit'] + self.stats['miss']
+            return dict(self.stats,
+                        hit_rate=self.stats['hit'] / requests if requests else 0.0,
+                        voci=len(self._entries),
+                        mb_occupati=self._bytes / 1024 / 1024,
+                        mb_massimi=self.max_bytes / 1024 / 1024)
+
+_cache = ResultCache()
+
+def cached(key, compute):
+    result = _cache.get(key)
+    if result is None:
+        result = compute()
+        _cache.put(key, result)
+
+    return result
+
+def get_cache_stats():
+    return _cache.get_stats()
+
+def clear_cache():
+    _cache.clear()
@@ -0,0 +1,7 @@
+import os
+import sys
+import tempfile
+
+# Moduli piatti nella radice del repository e un database SQLite usa e getta per la sessione di test
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ['db_path'] = os.path.join(tempfile.mkdtemp(), 'test_data.db')
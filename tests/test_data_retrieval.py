@@ -0,0 +1,14 @@
+from datetime import date
+
+from data_retrieval import missing_ranges
+
+def test_missing_ranges_by_covered_days():
+    completed = {(date(2024, 1, 1), date(2024, 1, 7)), (date(2024, 1, 15), date(2024, 1, 21))}
+
+    # Blocchi di un tentativo con un altro periodo e un'altra ampiezza: contano i giorni coperti
+    assert missing_ranges(date(2024, 1, 3), date(2024, 1, 25), completed) == [
+        (date(2024, 1, 8), date(2024, 1, 14)),
+        (date(2024, 1, 22), date(2024, 1, 25))
+    ]
+    assert missing_ranges(date(2024, 1, 2), date(2024, 1, 6), completed) == []
+    assert missing_ranges(date(2024, 2, 1), date(2024, 2, 3), set()) == [(date(2024, 2, 1), date(2024, 2, 3))]
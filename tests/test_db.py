@@ -0,0 +1,18 @@
+from db import get_connection, get_table_page, KEY_COLUMNS
+
+def test_table_page_by_rowid():
+    assert 'facebook_geo_data' not in KEY_COLUMNS
+
+    with get_connection() as conn:
+        conn.execute("DELETE FROM facebook_geo_data")
+        conn.executemany("INSERT INTO facebook_geo_data (account_id, date) VALUES (?, ?)",
+                         [('act_1', f"2024-01-{day % 28 + 1:02d}") for day in range(250)])
+
+    filters = [('date', '>=', '2024-01-01'), ('date', '<=', '2024-01-31')]
+    pages, after, has_next = [], None, True
+    while has_next:
+        df, after, has_next = get_table_page('facebook_geo_data', filters, ['rowid'], after)
+        pages.append(len(df))
+
+    assert pages == [100, 100, 50]
+    assert all(type(value) is int for value in after)
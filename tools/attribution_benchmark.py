@@ -0,0 +1,118 @@
+# Confronta i tempi della query di attribuzione a nove join con quella ad aggregazione condizionale.
+# Va lanciato dalla radice del progetto contro un database MySQL locale, mai quello di produzione:
+#
+#   python -m tools.attribution_benchmark --seed 50000 --runs 5
+#
+# --seed ricrea nel database bench_database (default delera_bench) le tabelle del CRM con i dati
+# sintetici di tools/fake_crm.py.
+import argparse
+import os
+import statistics
+import time
+from datetime import date, timedelta
+import environ
+import mysql.connector
+import pandas as pd
+
+from config import CUSTOM_FIELDS
+from data_retrieval import attribution_query, attribution_condition, attribution_transform
+from tools.fake_crm import seed, LOCATION_ID, PIPELINE_ID
+
+env = environ.Env()
+environ.Env.read_env()
+
+def legacy_attribution_query(update_type, start_date, end_date):
+    # Query originale, tenuta qui solo come termine di paragone
+    if update_type == "data_acquisizione":
+        filter_update = f"FROM_UNIXTIME(ccf_data.value / 1000, '%Y-%m-%d')"
+    elif update_type == "createdAt":
+        filter_update = f"DATE(o.createdAt)"
+    else:
+        filter_update = f"DATE(o.lastStageChangeAt)"
+
+    joins = {column: f"ccf_{column}" for column in CUSTOM_FIELDS}
+    joins['data_acquisizione'] = 'ccf_data'
+
+    return f"""
+                SELECT
+                    o.id AS id,
+                    o.createdAt AS createdAt,
+                    o.lastStageChangeAt AS lastStageChangeAt,
+                    ops.name AS pipeline_stage_name,
+                    o.monetaryValue AS opportunity_monetary_value,
+                    {', '.join(f"{alias}.value AS {column}" for column, alias in joins.items())}
+                FROM
+                    opportunities o
+                    INNER JOIN opportunity_pipeline_stages ops ON o.pipelineStageId = ops.id
+                    LEFT JOIN contacts c ON o.contactId = c.id
+                    {' '.join(f"LEFT JOIN contact_custom_fields {alias} ON c.id = {alias}.contactId AND {alias}.id = '{CUSTOM_FIELDS[column]}'" for column, alias in joins.items())}
+                WHERE
+                    o.locationId = '{os.environ['id_cliente']}'
+                    AND ops.pipelineId = '{os.environ['pipeline_vendita']}'
+                    AND {filter_update} BETWEEN '{start_date}' AND '{end_date}';
+            """
+
+def run(conn, query, runs):
+    timings, df = [], None
+
+    for _ in range(runs):
+        cursor = conn.cursor()
+        started = time.perf_counter()
+        cursor.execute(query)
+        rows = cursor.fetchall()
+        timings.append(time.perf_counter() - started)
+        df = pd.DataFrame(rows, columns=cursor.column_names)
+        cursor.close()
+
+    return timings, df
+
+def normalize(df):
+    df = attribution_transform(df)
+    return df.sort_values('id').reset_index(drop=True)[sorted(df.columns)].astype(str)
+
+def main():
+    parser = argparse.ArgumentParser(description="Tempi della query di attribuzione: prima e dopo")
+    parser.add_argument('--seed', type=int, default=0, help="Opportunità sintetiche da generare (0 usa i dati esistenti)")
+    parser.add_argument('--days', type=int, default=365, help="Giorni coperti dai dati sintetici")
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--update-type', default='data_acquisizione', choices=['data_acquisizione', 'createdAt', 'lastStageChangeAt'])
+    parser.add_argument('--start', type=date.fromisoformat, default=date.today() - timedelta(days=60))
+    parser.add_argument('--end', type=date.fromisoformat, default=date.today())
+    args = parser.parse_args()
+
+    conn = mysql.connector.connect(
+        host=env('bench_host', default='127.0.0.1'),
+        port=env.int('bench_port', default=3306),
+        user=env('bench_username', default='root'),
+        password=env('bench_password', default=''),
+        database=env('bench_database', default='delera_bench'))
+
+    if args.seed:
+        print(f"Generazione di {args.seed} opportunità...")
+        seed(conn, args.seed, args.days, placeholder='%s')
+
+    if args.seed or 'id_cliente' not in os.environ:
+        os.environ['id_cliente'] = LOCATION_ID
+        os.environ['pipeline_vendita'] = PIPELINE_ID
+
+    queries = {
+        'prima': legacy_attribution_query(args.update_type, args.start, args.end),
+        'dopo': attribution_query(attribution_condition(args.update_type, args.start, args.end))
+    }
+
+    results = {}
+    for name, query in queries.items():
+        timings, df = run(conn, query, args.runs)
+        results[name] = df
+        print(f"{name:>5}: {len(df)} righe, mediana {statistics.median(timings):.3f}s, minimo {min(timings):.3f}s")
+
+    # Con un fuso diverso da UTC sul server la query originale sposta i confini dei giorni
+    if normalize(results['prima']).equals(normalize(results['dopo'])):
+        print("Risultati identici")
+    else:
+        print("Attenzione: i risultati differiscono")
+
+    conn.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+# Finta API dei dati pubblicitari per misurare gli aggiornamenti senza la fonte reale:
+#
+#   python -m tools.fake_api --port 8765 --rows-per-day 500 --latency 0.2 --failure-rate 0.05
+#   source=http://127.0.0.1:8765/ api_key=x python ingest.py --days 90
+#
+# Serve facebook, google_ads, tiktok e googleanalytics4 con i campi di config.FIELDS. Le righe sono
+# deterministiche per fonte, giorno e indice: richieste ripetute aggiornano le stesse chiavi.
+import argparse
+import json
+import random
+import time
+import zlib
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from config import FIELDS
+
+NUMERIC_FIELDS = {
+    'spend', 'impressions', 'clicks', 'outbound_clicks_outbound_click', 'actions_lead', 'actions_purchase',
+    'total_sales_lead', 'total_purchase', 'sessions', 'engaged_sessions', 'active_users', 'user_engagement_duration'
+}
+AGES = ['18-24', '25-34', '35-44', '45-54', '55-64', '65+']
+GENDERS = ['male', 'female', 'unknown']
+CHUNK_ROWS = 500
+
+def make_record(source, day, index, fields, account_id):
+    rng = random.Random(f"{source}-{day}-{index}")
+    record = {}
+
+    for field in fields:
+        if field == 'date':
+            record[field] = str(day)
+        elif field == 'account_id':
+            record[field] = account_id
+        elif field in ('datasource', 'source'):
+            record[field] = source
+        elif field == 'campaign':
+            record[field] = f"Campagna {index}"
+        elif field == 'age':
+            record[field] = AGES[index % len(AGES)]
+        elif field == 'gender':
+            record[field] = GENDERS[index % len(GENDERS)]
+        elif field.endswith('status'):
+            record[field] = 'ACTIVE'
+        elif field == 'spend':
+            record[field] = round(rng.uniform(0, 50), 2)
+        elif field in NUMERIC_FIELDS:
+            record[field] = rng.randrange(0, 1000)
+        else:
+            record[field] = f"{field} {index}"
+
+    return record
+
+def make_handler(options):
+    class FakeAPIHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            source = urlparse(self.path).path.strip('/')
+            params = {name: values[0] for name, values in parse_qs(urlparse(self.path).query).items()}
+
+            if source not in FIELDS:
+                return self.send_error(404, f"Fonte {source} sconosciuta")
+            if 'date_from' not in params or 'date_to' not in params:
+                return self.send_error(400, "date_from e date_to sono obbligatori")
+
+            time.sleep(options.latency)
+            if random.random() < options.failure_rate:
+                return self.send_error(503, "Errore simulato")
+
+            fields = params.get('fields', FIELDS[source]).split(',')
+            start_date, end_date = date.fromisoformat(params['date_from']), date.fromisoformat(params['date_to'])
+            truncate = random.random() < options.truncate_rate
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Transfer-Encoding', 'chunked')
+            gzip_body = 'gzip' in self.headers.get('Accept-Encoding', '')
+            if gzip_body:
+                self.send_header('Content-Encoding', 'gzip')
+            self.end_headers()
+
+            # Corpo generato e compresso a blocchi: la memoria del server non cresce con il periodo
+            compressor = zlib.compressobj(wbits=31) if gzip_body else None
+            self.write_chunk(b'{"data": [', compressor)
+
+            day, first = start_date, True
+            while day <= end_date:
+                for offset in range(0, options.rows_per_day, CHUNK_ROWS):
+                    rows = [make_record(source, day, index, fields, options.account_id)
+                            for index in range(offset, min(offset + CHUNK_ROWS, options.rows_per_day))]
+                    payload = ", ".join(json.dumps(row) for row in rows)
+                    self.write_chunk((payload if first else ", " + payload).encode(), compressor)
+                    first = False
+
+                if truncate:
+                    # Connessione chiusa a metà risposta, come un timeout della fonte reale
+                    self.close_connection = True
+                    return
+                day += timedelta(days=1)
+
+            self.write_chunk(b'], "meta": {"source": "fake_api"}}', compressor)
+            if compressor:
+                self.write_chunk(compressor.flush(), None)
+            self.wfile.write(b"0\r\n\r\n")
+
+        def write_chunk(self, data, compressor):
+            if compressor:
+                data = compressor.compress(data)
+            if data:
+                self.wfile.write(f"{len(data):X}\r\n".encode() + data + b"\r\n")
+
+        def log_message(self, format, *args):
+            if not options.quiet:
+                super().log_message(format, *args)
+
+    return FakeAPIHandler
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Finta API dei dati pubblicitari")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--rows-per-day', type=int, default=200, help="Righe per fonte e per giorno")
+    parser.add_argument('--account-id', default='fake_account')
+    parser.add_argument('--latency', type=float, default=0.0, help="Secondi di attesa prima della risposta")
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="Quota di richieste che rispondono 503")
+    parser.add_argument('--truncate-rate', type=float, default=0.0, help="Quota di risposte interrotte dopo il primo giorno")
+    parser.add_argument('--quiet', action='store_true')
+
+    return parser.parse_args(argv)
+
+def serve(options):
+    server = ThreadingHTTPServer((options.host, options.port), make_handler(options))
+    server.daemon_threads = True
+
+    return server
+
+def main():
+    options = parse_args()
+    server = serve(options)
+    print(f"Finta API su http://{options.host}:{server.server_port}/", flush=True)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+# Copia locale e sintetica del database del CRM per misurare le estrazioni senza la produzione:
+#
+#   python -m tools.fake_crm seed --opportunities 50000 --days 365
+#   python -m tools.fake_crm bench --latency 0.01 --failure-rate 0.1 --start 2024-01-01 --end 2024-06-30
+#
+# Di default i dati vanno in un file SQLite (fake_crm_path) letto da FakeCRMPool, che imita il pool
+# MySQL con ritardi ed errori iniettati. Con --mysql seed scrive invece nel database bench_database.
+import argparse
+import os
+import random
+import sqlite3
+import threading
+import time
+from datetime import date, datetime, timedelta, timezone
+import environ
+import mysql.connector
+
+from config import ATTRIBUTION_SOURCES, CUSTOM_FIELDS, STAGES
+
+env = environ.Env()
+environ.Env.read_env()
+
+FAKE_CRM_PATH = env('fake_crm_path', default='fake_crm.db')
+LOCATION_ID = 'fake_location'
+PIPELINE_ID = 'fake_pipeline'
+SEED_BATCH = 5000
+
+# Fonti dei lead: i canali di ATTRIBUTION_SOURCES più alcuni valori che gli analyzer non riconoscono
+LEAD_SOURCES = list(ATTRIBUTION_SOURCES.values()) + ['Organico', 'Passaparola', 'Evento']
+LEAD_SOURCE_WEIGHTS = [4] * len(ATTRIBUTION_SOURCES) + [1, 1, 1]
+
+TABLES = {
+    'opportunity_pipeline_stages': "id VARCHAR(32) PRIMARY KEY, pipelineId VARCHAR(32), name VARCHAR(255)",
+    'users': "id VARCHAR(32) PRIMARY KEY, name VARCHAR(255)",
+    'contacts': "id VARCHAR(32) PRIMARY KEY, locationId VARCHAR(32)",
+    'opportunities': """id VARCHAR(32) PRIMARY KEY, locationId VARCHAR(32), contactId VARCHAR(32), pipelineStageId VARCHAR(32),
+                        assignedTo VARCHAR(32), monetaryValue DOUBLE, createdAt VARCHAR(32), lastStageChangeAt VARCHAR(32), updatedAt VARCHAR(32)""",
+    'contact_custom_fields': "contactId VARCHAR(32), id VARCHAR(32), value VARCHAR(255)",
+    'payment_transactions': """id VARCHAR(32) PRIMARY KEY, altId VARCHAR(32), contactId VARCHAR(32), createdAt VARCHAR(32), updatedAt VARCHAR(32),
+                               entitySourceName VARCHAR(255), entitySourceMeta VARCHAR(255), amount DOUBLE, currency VARCHAR(8), status VARCHAR(32)"""
+}
+
+INDEXES = [
+    ('opportunities', 'locationId, createdAt'),
+    ('opportunities', 'locationId, lastStageChangeAt'),
+    ('opportunities', 'locationId, updatedAt'),
+    ('contact_custom_fields', 'contactId, id'),
+    ('contact_custom_fields', 'id, value'),
+    ('payment_transactions', 'altId, createdAt'),
+    ('payment_transactions', 'altId, updatedAt')
+]
+
+def iso(moment):
+    return moment.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+def seed(conn, opportunities, days, placeholder='?', rng=None):
+    rng = rng or random.Random(0)
+    cursor = conn.cursor()
+
+    for table, columns in TABLES.items():
+        cursor.execute(f"DROP TABLE IF EXISTS {table}")
+        cursor.execute(f"CREATE TABLE {table} ({columns})")
+    for table, columns in INDEXES:
+        cursor.execute(f"CREATE INDEX {table}_{columns.replace(', ', '_')} ON {table} ({columns})")
+
+    def insert(table, rows):
+        if rows:
+            cursor.executemany(f"INSERT INTO {table} VALUES ({', '.join([placeholder] * len(rows[0]))})", rows)
+
+    stages = [(f"stage{i}", PIPELINE_ID, name) for i, name in enumerate(STAGES['stages'])]
+    insert('opportunity_pipeline_stages', stages)
+    insert('users', [(f"user{i}", f"Venditore {i}") for i in range(10)])
+
+    now = datetime.now(timezone.utc)
+    for offset in range(0, opportunities, SEED_BATCH):
+        contacts, opps, fields, payments = [], [], [], []
+
+        for i in range(offset, min(offset + SEED_BATCH, opportunities)):
+            created = now - timedelta(days=rng.uniform(0, days))
+            changed = min(created + timedelta(days=rng.uniform(0, 10)), now)
+            contacts.append((f"contact{i}", LOCATION_ID))
+            opps.append((f"opp{i}", LOCATION_ID, f"contact{i}", rng.choice(stages)[0], f"user{rng.randrange(10)}",
+                         rng.choice([0, 490, 990]), iso(created), iso(changed), iso(changed)))
+
+            for column, field_id in CUSTOM_FIELDS.items():
+                if rng.random() < 0.2:
+                    continue
+                if column.startswith('data_'):
+                    value = str(int(created.timestamp() * 1000))
+                elif column == 'fonte':
+                    value = rng.choices(LEAD_SOURCES, LEAD_SOURCE_WEIGHTS)[0]
+                else:
+                    value = f"{column} {rng.randrange(50)}"
+                fields.append((f"contact{i}", field_id, value))
+
+            if rng.random() < 0.3:
+                paid = min(changed + timedelta(days=rng.uniform(0, 5)), now)
+                payments.append((f"pay{i}", LOCATION_ID, f"contact{i}", iso(paid), iso(paid), "Abbonamento", "{}",
+                                 rng.choice([49.0, 490.0]), 'EUR', rng.choice(['succeeded', 'succeeded', 'failed'])))
+
+        insert('contacts', contacts)
+        insert('opportunities', opps)
+        insert('contact_custom_fields', fields)
+        insert('payment_transactions', payments)
+        conn.commit()
+
+    cursor.close()
+
+class FakeCursor:
+    def __init__(self, conn, pool):
+        self._cursor = conn.cursor()
+        self._pool = pool
+        self.column_names = ()
+
+    def execute(self, query, params=()):
+        time.sleep(self._pool.latency)
+        self._pool.maybe_fail("Errore simulato nell'esecuzione della query")
+
+        # Parametri nello stile di mysql.connector, sintassi compatibile con SQLite
+        self._cursor.execute(query.replace('%s', '?').strip().rstrip(';'), params)
+        self.column_names = tuple(column[0] for column in self._cursor.description or ())
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def fetchmany(self, size):
+        time.sleep(self._pool.latency)
+        self._pool.maybe_fail("Connessione interrotta durante la lettura", self._pool.break_rate)
+
+        return self._cursor.fetchmany(size)
+
+    def close(self):
+        self._cursor.close()
+
+class FakeConnection:
+    unread_result = False
+
+    def __init__(self, pool):
+        self._pool = pool
+        self._conn = sqlite3.connect(pool.path, check_same_thread=False)
+
+    def cursor(self, buffered=None):
+        return FakeCursor(self._conn, self._pool)
+
+    def consume_results(self):
+        pass
+
+    def close(self):
+        self._conn.close()
+        with self._pool.lock:
+            self._pool.stats['chiuse'] += 1
+
+class FakeCRMPool:
+    # Stessa interfaccia del pool del CRM usata da data_retrieval: get_connection() e close()
+    def __init__(self, path=FAKE_CRM_PATH, latency=0.0, failure_rate=0.0, break_rate=0.0):
+        self.path = path
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.break_rate = break_rate
+        self.lock = threading.Lock()
+        self.stats = {'aperte': 0, 'chiuse': 0, 'errori_iniettati': 0}
+
+    def get_connection(self):
+        time.sleep(self.latency)
+        with self.lock:
+            self.stats['aperte'] += 1
+
+        return FakeConnection(self)
+
+    def maybe_fail(self, message, rate=None):
+        if random.random() < (self.failure_rate if rate is None else rate):
+            with self.lock:
+                self.stats['errori_iniettati'] += 1
+            raise mysql.connector.errors.OperationalError(message)
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats)
+
+def bench(args):
+    # Le estrazioni reali di data_retrieval contro il finto CRM, con i tempi per fase di ingest_metrics
+    from crm_pool import use_pool
+    from db import initialize_database
+    from ingestion import CRM_TABLES, build_tasks, run_ingestion
+
+    os.environ['id_cliente'] = LOCATION_ID
+    os.environ['pipeline_vendita'] = PIPELINE_ID
+
+    pool = FakeCRMPool(args.path, args.latency, args.failure_rate, args.break_rate)
+    use_pool(pool)
+    initialize_database()
+
+    tasks = build_tasks(args.start, args.end, args.opp_date, args.lead_date, full_refresh=True,
+                        crm_changes=args.crm_changes, tables=args.tables or CRM_TABLES)
+
+    started = time.perf_counter()
+    for table_name, result, error in run_ingestion(tasks, 'fake_crm'):
+        print(f"{table_name}: {error if error else result}")
+
+    print(f"Totale {time.perf_counter() - started:.2f}s, pool {pool.get_stats()}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Finto database del CRM")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    seed_parser = commands.add_parser('seed', help="Genera i dati sintetici")
+    seed_parser.add_argument('--opportunities', type=int, default=10000)
+    seed_parser.add_argument('--days', type=int, default=365)
+    seed_parser.add_argument('--path', default=FAKE_CRM_PATH)
+    seed_parser.add_argument('--mysql', action='store_true', help="Scrive in bench_database invece che nel file SQLite")
+
+    bench_parser = commands.add_parser('bench', help="Esegue le estrazioni del CRM contro i dati sintetici")
+    bench_parser.add_argument('--path', default=FAKE_CRM_PATH)
+    bench_parser.add_argument('--start', type=date.fromisoformat, default=date.today() - timedelta(days=365))
+    bench_parser.add_argument('--end', type=date.fromisoformat, default=date.today())
+    bench_parser.add_argument('--tables', nargs='+')
+    bench_parser.add_argument('--opp-date', default='createdAt', choices=['createdAt', 'lastStageChangeAt'])
+    bench_parser.add_argument('--lead-date', default='data_acquisizione', choices=['data_acquisizione', 'createdAt', 'lastStageChangeAt'])
+    bench_parser.add_argument('--crm-changes', action='store_true')
+    bench_parser.add_argument('--latency', type=float, default=0.0, help="Secondi di attesa per connessione, query e blocco letto")
+    bench_parser.add_argument('--failure-rate', type=float, default=0.0, help="Quota di query che falliscono")
+    bench_parser.add_argument('--break-rate', type=float, default=0.0, help="Quota di blocchi letti che interrompono la connessione")
+
+    args = parser.parse_args()
+
+    if args.command == 'seed':
+        if args.mysql:
+            conn = mysql.connector.connect(
+                host=env('bench_host', default='127.0.0.1'),
+                port=env.int('bench_port', default=3306),
+                user=env('bench_username', default='root'),
+                password=env('bench_password', default=''),
+                database=env('bench_database', default='delera_bench'))
+            seed(conn, args.opportunities, args.days, placeholder='%s')
+        else:
+            conn = sqlite3.connect(args.path)
+            seed(conn, args.opportunities, args.days)
+        conn.close()
+        print(f"Generate {args.opportunities} opportunità")
+    else:
+        bench(args)
+
+if __name__ == '__main__':
+    main()